@@ -0,0 +1,5 @@
+def find_dependency(container, cls):
+    for dependency in container.dependencies:
+        if isinstance(dependency, cls):
+            return dependency
+    return None
@@ -0,0 +1,79 @@
+import time
+from nameko.extensions import DependencyProvider
+
+
+class ProviderUsersCache(object):
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.entries = {}
+        self.users = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_many(self, providers):
+        now = time.monotonic()
+        found = {}
+        missing = []
+        for provider in providers:
+            entry = self.entries.get(provider)
+            if entry is not None and entry[0] > now:
+                found[provider] = entry[1]
+                self.hits += 1
+            else:
+                missing.append(provider)
+                self.misses += 1
+        return found, missing
+
+    def set(self, provider, users):
+        self.entries[provider] = (time.monotonic() + self.ttl, users)
+
+    def get_user_providers(self, user):
+        entry = self.users.get(user)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def set_user_providers(self, user, providers):
+        self.users[user] = (time.monotonic() + self.ttl, providers)
+
+    def invalidate_user(self, user, providers):
+        if self.users.pop(user, None) is not None:
+            self.invalidations += 1
+        stale = set(providers)
+        stale.update(p for p, (_, users) in self.entries.items() if user in users)
+        for provider in stale:
+            if self.entries.pop(provider, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.entries) + len(self.users)
+        self.entries.clear()
+        self.users.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'users': len(self.users),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.,
+            'invalidations': self.invalidations
+        }
+
+
+class AllowedUsersCache(DependencyProvider):
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.cache = None
+
+    def setup(self):
+        self.cache = ProviderUsersCache(self.container.config.get('ALLOWED_USERS_CACHE_TTL', self.ttl))
+
+    def get_dependency(self, worker_ctx):
+        return self.cache
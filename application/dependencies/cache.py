@@ -0,0 +1,116 @@
+import time
+from collections import OrderedDict, defaultdict
+from nameko.extensions import DependencyProvider
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=10000, ttl=60, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh or (lambda value: 1)
+        self.weight = 0
+        self.entries = OrderedDict()
+        self.tags = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value, _ = entry
+        if expires <= time.monotonic():
+            self._pop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, tags=()):
+        if key in self.entries:
+            self._pop(key)
+        weight = self.weigh(value)
+        if weight > self.maxsize:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value, tags)
+        self.weight += weight
+        for tag in tags:
+            self.tags[tag].add(key)
+        while self.weight > self.maxsize:
+            self._pop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _pop(self, key):
+        _, value, tags = self.entries.pop(key)
+        self.weight -= self.weigh(value)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            for key in list(self.tags.get(tag, ())):
+                self._pop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.tags.clear()
+        self.weight = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'weight': self.weight,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations
+        }
+
+
+class ResponseCache(DependencyProvider):
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache = None
+
+    def setup(self):
+        config = self.container.config
+        self.cache = LRUCache(config.get('RESPONSE_CACHE_SIZE', self.maxsize),
+                              config.get('RESPONSE_CACHE_TTL', self.ttl))
+
+    def get_dependency(self, worker_ctx):
+        return self.cache
+
+
+class PictureCache(DependencyProvider):
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=24 * 60 * 60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cache = None
+
+    def setup(self):
+        config = self.container.config
+        self.cache = LRUCache(config.get('PICTURE_CACHE_MAX_BYTES', self.max_bytes),
+                              config.get('PICTURE_CACHE_TTL', self.ttl), weigh=lambda value: len(value[1]))
+
+    def get_dependency(self, worker_ctx):
+        return self.cache
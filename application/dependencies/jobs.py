@@ -0,0 +1,41 @@
+import logging
+from collections import defaultdict
+from eventlet.semaphore import Semaphore
+from nameko.extensions import DependencyProvider
+
+
+_log = logging.getLogger(__name__)
+
+
+class BackgroundJobs(object):
+
+    def __init__(self, spawn=None):
+        self.spawn = spawn
+        self.locks = defaultdict(Semaphore)
+
+    def _run(self, key, fn, *args):
+        with self.locks[key]:
+            return fn(*args)
+
+    def _run_guarded(self, key, fn, *args):
+        try:
+            self._run(key, fn, *args)
+        except Exception:
+            _log.exception(f'Background job for {key} failed')
+
+    def submit(self, key, fn, *args):
+        if self.spawn is None:
+            return self._run(key, fn, *args)
+        self.spawn(lambda: self._run_guarded(key, fn, *args))
+
+
+class JobRunner(DependencyProvider):
+
+    def __init__(self):
+        self.jobs = None
+
+    def setup(self):
+        self.jobs = BackgroundJobs(self.container.spawn_managed_thread)
+
+    def get_dependency(self, worker_ctx):
+        return self.jobs
@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+from nameko.extensions import DependencyProvider
+
+
+_log = logging.getLogger(__name__)
+
+
+class LabelDictionary(object):
+
+    def __init__(self, refresh_interval=1., reload_interval=300.):
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.by_key = {}
+        self.by_id = {}
+        self.version = None
+        self.last_refresh = 0.
+        self.last_reload = 0.
+        self.refreshes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _add(by_key, by_id, doc):
+        label = {'id': doc['id'], 'language': doc['language'], 'context': doc['context'], 'label': doc.get('label')}
+        key = (label['id'], label['language'], label['context'])
+        by_key[key] = label
+        by_id.setdefault(label['id'], {})[key] = label
+
+    def _set(self, doc):
+        self._add(self.by_key, self.by_id, doc)
+
+    def _delete(self, doc):
+        key = (doc['id'], doc['language'], doc['context'])
+        if self.by_key.pop(key, None) is not None:
+            labels = self.by_id[doc['id']]
+            del labels[key]
+            if not labels:
+                del self.by_id[doc['id']]
+
+    @staticmethod
+    def _current_version(database):
+        counter = database.counters.find_one({'_id': 'labels'})
+        return counter['version'] if counter else 0
+
+    def _reload(self, database):
+        start = time.monotonic()
+        version = self._current_version(database)
+        by_key = {}
+        by_id = {}
+        for doc in database.labels.find({}, {'_id': 0}):
+            self._add(by_key, by_id, doc)
+        self.by_key, self.by_id, self.version = by_key, by_id, version
+        self.last_reload = time.monotonic()
+        _log.info(f'{len(self.by_key)} labels loaded in memory in {time.monotonic() - start:.2f}s (version {version})')
+        return len(self.by_key)
+
+    def refresh(self, database, force=False):
+        if not force and time.monotonic() - self.last_refresh < self.refresh_interval:
+            return 0
+        # Callers wait for the first load instead of reading an empty dictionary
+        initial = self.version is None
+        if not self.lock.acquire(blocking=initial):
+            return 0
+        try:
+            if initial and self.version is not None:
+                return 0
+            self.last_refresh = time.monotonic()
+            self.refreshes += 1
+            if self.version is None or time.monotonic() - self.last_reload >= self.reload_interval:
+                return self._reload(database)
+
+            if self._current_version(database) == self.version:
+                return 0
+
+            query = {'version': {'$gt': self.version}}
+            changes = [(doc['version'], self._set, doc) for doc in database.labels.find(query, {'_id': 0})]
+            changes.extend((doc['version'], self._delete, doc)
+                           for doc in database.label_tombstones.find(query, {'_id': 0}))
+            changes.sort(key=lambda change: change[0])
+            for version, apply, doc in changes:
+                apply(doc)
+                self.version = version
+            return len(changes)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.version = None
+
+    def get(self, id, language, context):
+        return self.by_key.get((id, language, context))
+
+    def get_many(self, ids, language, context):
+        found = (self.by_key.get((id, language, context)) for id in dict.fromkeys(ids))
+        return [label for label in found if label is not None]
+
+    def get_by_id(self, ids):
+        return [label for id in dict.fromkeys(ids) for label in self.by_id.get(id, {}).values()]
+
+    def stats(self):
+        return {
+            'size': len(self.by_key),
+            'ids': len(self.by_id),
+            'version': self.version,
+            'refreshes': self.refreshes
+        }
+
+
+class LabelSnapshot(DependencyProvider):
+
+    def __init__(self, refresh_interval=1., reload_interval=300.):
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.labels = None
+
+    def setup(self):
+        config = self.container.config
+        self.labels = LabelDictionary(config.get('LABELS_REFRESH_INTERVAL', self.refresh_interval),
+                                      config.get('LABELS_RELOAD_INTERVAL', self.reload_interval))
+
+    def get_dependency(self, worker_ctx):
+        return self.labels
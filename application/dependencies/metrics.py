@@ -0,0 +1,202 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+from pymongo import monitoring
+from nameko.extensions import DependencyProvider
+
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_ENTRYPOINT_TYPES = {'Rpc': 'rpc', 'EventHandler': 'event', 'HttpRequestHandler': 'http'}
+
+_current = threading.local()
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for le, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield le, total
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': [['+Inf' if le == float('inf') else le, count] for le, count in self.cumulative()]
+        }
+
+
+class MetricsRegistry(object):
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.inflight = defaultdict(int)
+        self.latency = defaultdict(Histogram)
+        self.mongo_latency = defaultdict(Histogram)
+        self.mongo_commands = defaultdict(int)
+        self.mongo_seconds = defaultdict(float)
+
+    def start(self, key):
+        self.inflight[key] += 1
+
+    def finish(self, key, elapsed, error, commands):
+        self.inflight[key] -= 1
+        self.calls[key] += 1
+        if error:
+            self.errors[key] += 1
+        self.latency[key].observe(elapsed)
+        mongo_elapsed = 0.
+        for command, (count, seconds) in commands.items():
+            self.mongo_commands[key + (command,)] += count
+            self.mongo_seconds[key + (command,)] += seconds
+            mongo_elapsed += seconds
+        self.mongo_latency[key].observe(mongo_elapsed)
+
+    def snapshot(self):
+        entrypoints = {}
+        for key in set(self.calls) | set(self.inflight):
+            entrypoints['{}.{}'.format(*key)] = {
+                'calls': self.calls[key],
+                'errors': self.errors[key],
+                'inflight': self.inflight[key],
+                'latency': self.latency[key].snapshot(),
+                'mongo_latency': self.mongo_latency[key].snapshot(),
+                'mongo_commands': dict((k[2], v) for k, v in self.mongo_commands.items() if k[:2] == key),
+                'mongo_seconds': dict((k[2], v) for k, v in self.mongo_seconds.items() if k[:2] == key)
+            }
+        return {
+            'max_workers': self.max_workers,
+            'inflight': sum(self.inflight.values()),
+            'entrypoints': entrypoints
+        }
+
+    def render(self):
+        lines = []
+
+        def labels(key):
+            names = ('type', 'entrypoint', 'command')
+            return ','.join('{}="{}"'.format(n, v) for n, v in zip(names, key))
+
+        def metric(name, kind, help, values):
+            lines.append('# HELP referential_{} {}'.format(name, help))
+            lines.append('# TYPE referential_{} {}'.format(name, kind))
+            for key, value in sorted(values.items()):
+                lines.append('referential_{}{{{}}} {}'.format(name, labels(key), value))
+
+        def histogram(name, help, histograms):
+            lines.append('# HELP referential_{} {}'.format(name, help))
+            lines.append('# TYPE referential_{} histogram'.format(name))
+            for key, h in sorted(histograms.items()):
+                for le, count in h.cumulative():
+                    lines.append('referential_{}_bucket{{{},le="{}"}} {}'.format(
+                        name, labels(key), '+Inf' if le == float('inf') else le, count))
+                lines.append('referential_{}_sum{{{}}} {}'.format(name, labels(key), h.sum))
+                lines.append('referential_{}_count{{{}}} {}'.format(name, labels(key), h.count))
+
+        if self.max_workers is not None:
+            lines.append('# HELP referential_max_workers Worker pool size of the service container')
+            lines.append('# TYPE referential_max_workers gauge')
+            lines.append('referential_max_workers {}'.format(self.max_workers))
+        metric('calls_total', 'counter', 'Completed worker calls', self.calls)
+        metric('errors_total', 'counter', 'Worker calls that raised', self.errors)
+        metric('inflight_workers', 'gauge', 'Workers currently running', self.inflight)
+        histogram('latency_seconds', 'Worker call latency', self.latency)
+        histogram('mongo_latency_seconds', 'Time spent in Mongo commands per worker call', self.mongo_latency)
+        metric('mongo_commands_total', 'counter', 'Mongo commands issued by worker calls', self.mongo_commands)
+        metric('mongo_seconds_total', 'counter', 'Time spent in Mongo commands', self.mongo_seconds)
+        return '\n'.join(lines) + '\n'
+
+
+class WorkerCall(object):
+
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+        self.error = False
+        self.commands = {}
+        self.started = time.perf_counter()
+        registry.start(key)
+
+    def command(self, name, seconds):
+        count, total = self.commands.get(name, (0, 0.))
+        self.commands[name] = (count + 1, total + seconds)
+
+    def finish(self):
+        self.registry.finish(self.key, time.perf_counter() - self.started, self.error, self.commands)
+
+
+def current_call():
+    return getattr(_current, 'call', None)
+
+
+class WorkerCommandListener(monitoring.CommandListener):
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        call = current_call()
+        if call is not None:
+            call.command(event.command_name, event.duration_micros / 1e6)
+
+
+monitoring.register(WorkerCommandListener())
+
+
+def entrypoint_key(worker_ctx):
+    entrypoint = worker_ctx.entrypoint
+    return (_ENTRYPOINT_TYPES.get(type(entrypoint).__name__, type(entrypoint).__name__.lower()),
+            entrypoint.method_name)
+
+
+class Metrics(DependencyProvider):
+
+    def __init__(self):
+        self.registry = None
+        self.calls = {}
+
+    def setup(self):
+        self.registry = MetricsRegistry(self.container.max_workers)
+
+    def worker_setup(self, worker_ctx):
+        call = WorkerCall(self.registry, entrypoint_key(worker_ctx))
+        self.calls[worker_ctx] = call
+        _current.call = call
+
+    def worker_result(self, worker_ctx, result=None, exc_info=None):
+        call = self.calls.get(worker_ctx)
+        if call is not None:
+            call.error = exc_info is not None
+
+    def worker_teardown(self, worker_ctx):
+        call = self.calls.pop(worker_ctx, None)
+        if call is not None:
+            call.finish()
+        _current.call = None
+
+    def get_dependency(self, worker_ctx):
+        return self.registry
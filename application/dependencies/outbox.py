@@ -0,0 +1,107 @@
+import datetime
+import logging
+import eventlet
+from pymongo import ASCENDING, ReturnDocument
+from nameko.extensions import DependencyProvider
+from nameko.standalone.events import event_dispatcher
+from nameko_mongodb.database import MongoDatabase
+
+from application.dependencies import find_dependency
+
+
+_log = logging.getLogger(__name__)
+
+
+class Outbox(object):
+
+    def __init__(self, batch_size=500, gap_timeout=60.):
+        self.batch_size = batch_size
+        self.gap_timeout = gap_timeout
+
+    @staticmethod
+    def record(database, changes):
+        changes = [c for c in changes if c.get('id') is not None]
+        if not changes:
+            return None
+        last = database.counters.find_one_and_update({'_id': 'changes'}, {'$inc': {'version': len(changes)}},
+            upsert=True, return_document=ReturnDocument.AFTER)['version']
+        now = datetime.datetime.utcnow()
+        database.changes.insert_many([dict(change, version=last - len(changes) + 1 + i, at=now, dispatched=False)
+                                      for i, change in enumerate(changes)], ordered=False)
+        return last
+
+    @staticmethod
+    def latest(database):
+        counter = database.counters.find_one({'_id': 'changes'})
+        return counter['version'] if counter else 0
+
+    def since(self, collection, version, limit=1000):
+        # Versions are reserved before their records are inserted, so a later version can be visible while an
+        # earlier one is still in flight: stop at the first gap until it is old enough to be an abandoned reservation.
+        horizon = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.gap_timeout)
+        changes = []
+        expected = version + 1
+        for change in collection.find({'version': {'$gt': version}}, {'_id': 0, 'dispatched': 0}) \
+                .sort('version', ASCENDING).limit(limit):
+            if change['version'] != expected and change['at'] > horizon:
+                break
+            changes.append(change)
+            expected = change['version'] + 1
+        return changes
+
+    def relay(self, database, dispatch):
+        relayed = 0
+        while True:
+            batch = list(database.changes.find({'dispatched': False}, {'_id': 0, 'dispatched': 0})
+                         .sort('version', ASCENDING).limit(self.batch_size))
+            if not batch:
+                return relayed
+            for change in batch:
+                change['at'] = change['at'].isoformat()
+            dispatch('changes', {'changes': batch})
+            database.changes.update_many({'version': {'$in': [c['version'] for c in batch]}},
+                                         {'$set': {'dispatched': True}})
+            relayed += len(batch)
+            if len(batch) < self.batch_size:
+                return relayed
+
+
+class ChangeRelay(DependencyProvider):
+
+    def __init__(self, interval=1., batch_size=500, gap_timeout=60.):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.gap_timeout = gap_timeout
+        self.outbox = None
+        self.relay = None
+
+    def setup(self):
+        config = self.container.config
+        self.interval = config.get('CHANGES_RELAY_INTERVAL', self.interval)
+        self.outbox = Outbox(config.get('CHANGES_RELAY_BATCH_SIZE', self.batch_size),
+                             config.get('CHANGES_GAP_TIMEOUT', self.gap_timeout))
+
+    def start(self):
+        if self.interval:
+            self.relay = self.container.spawn_managed_thread(self._run, identifier='change_relay')
+
+    def _run(self):
+        dispatch = event_dispatcher(self.container.config)
+
+        def dispatch_changes(event_type, payload):
+            dispatch(self.container.service_name, event_type, payload)
+
+        while True:
+            eventlet.sleep(self.interval)
+            try:
+                self.outbox.relay(find_dependency(self.container, MongoDatabase).db, dispatch_changes)
+            except Exception:
+                _log.exception('Unable to relay referential changes')
+
+    def stop(self):
+        if self.relay is not None:
+            self.relay.kill()
+            self.relay = None
+
+    def get_dependency(self, worker_ctx):
+        return self.outbox
@@ -0,0 +1,113 @@
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from nameko.extensions import DependencyProvider
+
+
+_READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+
+_READ_PREFIXES = ('get_', 'search_', 'fuzzy_search')
+
+
+def is_read(method_name):
+    return method_name.startswith(_READ_PREFIXES)
+
+
+def read_preference(name, max_staleness_seconds=-1):
+    if name not in _READ_PREFERENCES:
+        raise ValueError('Unknown read preference {}'.format(name))
+    if name == 'primary':
+        return Primary()
+    return _READ_PREFERENCES[name](max_staleness=max_staleness_seconds if max_staleness_seconds else -1)
+
+
+class BudgetedCollection(object):
+
+    def __init__(self, collection, max_time_ms):
+        self.collection = collection
+        self.max_time_ms = max_time_ms
+
+    def find(self, *args, **kwargs):
+        kwargs.setdefault('max_time_ms', self.max_time_ms)
+        return self.collection.find(*args, **kwargs)
+
+    def find_one(self, *args, **kwargs):
+        kwargs.setdefault('max_time_ms', self.max_time_ms)
+        return self.collection.find_one(*args, **kwargs)
+
+    def aggregate(self, pipeline, **kwargs):
+        kwargs.setdefault('maxTimeMS', self.max_time_ms)
+        return self.collection.aggregate(pipeline, **kwargs)
+
+    def count_documents(self, filter, **kwargs):
+        kwargs.setdefault('maxTimeMS', self.max_time_ms)
+        return self.collection.count_documents(filter, **kwargs)
+
+    def distinct(self, key, filter=None, **kwargs):
+        kwargs.setdefault('maxTimeMS', self.max_time_ms)
+        return self.collection.distinct(key, filter, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+class Route(object):
+
+    def __init__(self, read_preference=None, read_concern=None, max_time_ms=None):
+        self.read_preference = read_preference
+        self.read_concern = read_concern
+        self.max_time_ms = max_time_ms
+
+    def database(self, database):
+        options = {}
+        if self.read_preference is not None:
+            options['read_preference'] = self.read_preference
+        if self.read_concern is not None:
+            options['read_concern'] = ReadConcern(self.read_concern)
+        return database.with_options(**options) if options else database
+
+    def collection(self, database, name):
+        collection = self.database(database)[name]
+        if self.max_time_ms:
+            collection = BudgetedCollection(collection, self.max_time_ms)
+        return collection
+
+
+class Routing(DependencyProvider):
+
+    def __init__(self):
+        self.routes = {}
+        self.default_read = None
+        self.default_write = None
+
+    def _route(self, settings, read):
+        if not read:
+            return Route(max_time_ms=settings.get('max_time_ms'))
+        return Route(read_preference(settings.get('read_preference', 'primary'),
+                                     settings.get('max_staleness_seconds', -1)),
+                     settings.get('read_concern'), settings.get('max_time_ms'))
+
+    def configure(self, config):
+        config = dict(config.get('MONGODB_ROUTING') or {})
+        overrides = config.pop('rpcs', None) or {}
+        self.default_read = self._route(config, read=True)
+        self.default_write = self._route(config, read=False)
+        self.routes = dict((name, self._route(dict(config, **settings), is_read(name)))
+                           for name, settings in overrides.items())
+
+    def route(self, method_name):
+        route = self.routes.get(method_name)
+        if route is None:
+            route = self.default_read if is_read(method_name) else self.default_write
+        return route
+
+    def setup(self):
+        self.configure(self.container.config)
+
+    def get_dependency(self, worker_ctx):
+        return self.route(worker_ctx.entrypoint.method_name)
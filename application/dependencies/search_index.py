@@ -0,0 +1,230 @@
+import array
+import datetime
+import heapq
+import logging
+import string
+import threading
+import time
+import zlib
+from collections import defaultdict
+from nameko.extensions import DependencyProvider
+
+
+_log = logging.getLogger(__name__)
+
+_PUNCTUATION = str.maketrans({key: None for key in string.punctuation})
+
+
+def trigrams(words):
+    grams = set()
+    prefixes = set()
+    for word in words.lower().split(' '):
+        clean_word = word.translate(_PUNCTUATION)
+        if not clean_word:
+            continue
+        prefixes.add(clean_word[0:3])
+        grams.update(clean_word[i: i+3] for i in range(0, max(0, len(clean_word) - 3) + 1))
+    return grams, prefixes
+
+
+TRIGRAM_BITS = 24
+PREFIX_FLAG = 1 << TRIGRAM_BITS
+
+
+def trigram_id(gram):
+    return zlib.crc32(gram.encode('utf-8')) & (PREFIX_FLAG - 1)
+
+
+def hashed_trigrams(words):
+    grams, prefixes = trigrams(words)
+    ids = set(trigram_id(g) for g in grams)
+    ids.update(trigram_id(g) | PREFIX_FLAG for g in prefixes)
+    return sorted(ids)
+
+
+def query_trigrams(words):
+    grams, _ = trigrams(words)
+    return sorted(set(trigram_id(g) for g in grams))
+
+
+class TrigramIndex(object):
+
+    NGRAMS_WEIGHT = 100
+    PREFIX_WEIGHT = 200
+
+    def __init__(self):
+        self.postings = defaultdict(lambda: array.array('I'))
+        self.prefix_postings = defaultdict(lambda: array.array('I'))
+        self.positions = {}
+        self.ids = []
+        self.names = []
+        self.types = []
+        self.providers = []
+        self.users = []
+        self.alive = bytearray()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, doc):
+        self.remove(doc['id'])
+
+        position = len(self.ids)
+        self.positions[doc['id']] = position
+        self.ids.append(doc['id'])
+        self.names.append(doc['common_name'])
+        self.types.append(doc.get('type'))
+        self.providers.append(doc.get('provider'))
+        self.users.append(frozenset(doc.get('allowed_users', [])))
+        self.alive.append(1)
+
+        grams, prefixes = trigrams(doc['common_name'])
+        for gram in grams:
+            self.postings[gram].append(position)
+        for gram in prefixes:
+            self.prefix_postings[gram].append(position)
+
+    def same(self, doc):
+        position = self.positions.get(doc['id'])
+        return (position is not None
+                and self.names[position] == doc['common_name']
+                and self.types[position] == doc.get('type')
+                and self.providers[position] == doc.get('provider')
+                and self.users[position] == frozenset(doc.get('allowed_users', [])))
+
+    def remove(self, id):
+        position = self.positions.pop(id, None)
+        if position is not None:
+            self.alive[position] = 0
+            self.users[position] = frozenset()
+
+    @property
+    def dead(self):
+        return len(self.ids) - len(self.positions)
+
+    def compact(self):
+        compacted = TrigramIndex()
+        for position in sorted(self.positions.values()):
+            compacted.add({
+                'id': self.ids[position],
+                'common_name': self.names[position],
+                'type': self.types[position],
+                'provider': self.providers[position],
+                'allowed_users': self.users[position]
+            })
+        return compacted
+
+    def search(self, query, user, type=None, provider=None, limit=-1, providers=None):
+        grams, _ = trigrams(query)
+        scores = defaultdict(int)
+        for gram in grams:
+            for position in self.postings.get(gram, ()):
+                scores[position] += self.NGRAMS_WEIGHT
+            for position in self.prefix_postings.get(gram, ()):
+                scores[position] += self.PREFIX_WEIGHT
+
+        def visible(position):
+            return (self.alive[position]
+                    and (user in self.users[position] if providers is None
+                         else self.providers[position] in providers)
+                    and (type is None or self.types[position] == type)
+                    and (provider is None or self.providers[position] == provider))
+
+        candidates = ((score, -position) for position, score in scores.items() if visible(position))
+        if limit < 0:
+            best = sorted(candidates, reverse=True)
+        else:
+            best = heapq.nlargest(limit, candidates)
+
+        return [{'id': self.ids[-p], 'common_name': self.names[-p], 'score': s} for s, p in best]
+
+
+class InMemorySearch(object):
+
+    def __init__(self, enabled=False, refresh_interval=1., reload_interval=300., margin=300.):
+        self.enabled = enabled
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.margin = margin
+        self.index = TrigramIndex()
+        self.loaded = False
+        self.last_stamp = None
+        self.last_refresh = 0.
+        self.last_reload = 0.
+        self.lock = threading.Lock()
+
+    def _load(self, cursor, index):
+        count = 0
+        for doc in cursor:
+            if not index.same(doc):
+                index.add(doc)
+            count += 1
+            stamp = doc.get('updated_at')
+            if stamp is not None and (self.last_stamp is None or stamp > self.last_stamp):
+                self.last_stamp = stamp
+        return count
+
+    def refresh(self, collection, force=False):
+        if not force and time.monotonic() - self.last_refresh < self.refresh_interval:
+            return 0
+        # Callers wait for the first load instead of searching an empty index
+        initial = not self.loaded
+        if not self.lock.acquire(blocking=initial):
+            return 0
+        try:
+            if initial and self.loaded:
+                return 0
+            self.last_refresh = time.monotonic()
+            project = {'id': 1, 'common_name': 1, 'type': 1, 'provider': 1, 'allowed_users': 1, 'updated_at': 1, '_id': 0}
+            if not self.loaded or time.monotonic() - self.last_reload >= self.reload_interval:
+                start = time.monotonic()
+                index = TrigramIndex()
+                # The full load is routed but not bound by the caller's time budget
+                count = self._load(collection.find({}, project, max_time_ms=None), index)
+                self.index = index
+                self.loaded = True
+                self.last_reload = time.monotonic()
+                _log.info(f'{count} search entries loaded in memory in {time.monotonic() - start:.2f}s')
+                return count
+
+            # Entries can commit with a stamp older than the watermark (long update_many, concurrent flushes,
+            # clock skew), so look back a margin; unchanged entries are not re-indexed
+            if self.last_stamp:
+                query = {'updated_at': {'$gte': self.last_stamp - datetime.timedelta(seconds=self.margin)}}
+            else:
+                query = {'updated_at': {'$exists': True}}
+            count = self._load(collection.find(query, project), self.index)
+            if self.index.dead > len(self.index):
+                self.index = self.index.compact()
+            return count
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        with self.lock:
+            self.index = TrigramIndex()
+            self.loaded = False
+            self.last_stamp = None
+
+    def search(self, query, user, type=None, provider=None, limit=-1, providers=None):
+        return self.index.search(query, user, type, provider, limit, providers)
+
+
+class SearchIndex(DependencyProvider):
+
+    def __init__(self, refresh_interval=1., reload_interval=300., margin=300.):
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.margin = margin
+        self.engine = None
+
+    def setup(self):
+        config = self.container.config
+        self.engine = InMemorySearch(
+            enabled=config.get('SEARCH_ENGINE', 'mongo') == 'memory',
+            refresh_interval=config.get('SEARCH_INDEX_REFRESH_INTERVAL', self.refresh_interval),
+            reload_interval=config.get('SEARCH_INDEX_RELOAD_INTERVAL', self.reload_interval),
+            margin=config.get('SEARCH_INCREMENTAL_MARGIN', self.margin))
+
+    def get_dependency(self, worker_ctx):
+        return self.engine
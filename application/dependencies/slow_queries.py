@@ -0,0 +1,231 @@
+import datetime
+import json
+import logging
+import random
+import threading
+from bson.son import SON
+from pymongo import monitoring
+from pymongo.errors import CollectionInvalid, PyMongoError
+from nameko.extensions import DependencyProvider
+from nameko_mongodb.database import MongoDatabase
+
+from application.dependencies import find_dependency
+from application.dependencies.metrics import entrypoint_key
+
+
+_log = logging.getLogger(__name__)
+
+_SHAPE_FIELDS = {
+    'find': ('filter', 'sort', 'projection'),
+    'aggregate': ('pipeline',),
+    'count': ('query',),
+    'distinct': ('key', 'query'),
+    'findAndModify': ('query', 'sort'),
+    'update': ('updates',),
+    'delete': ('deletes',)
+}
+
+_UNREDACTED_FIELDS = ('sort', 'projection', 'key')
+
+_PLAN_LITERAL_FIELDS = frozenset(['filter', 'parsedQuery', 'indexBounds'])
+
+_SESSION_FIELDS = frozenset(['lsid', 'txnNumber', 'autocommit', 'startTransaction', 'readConcern', 'writeConcern'])
+
+_current = threading.local()
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return dict((k, redact(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(v, dict) for v in value):
+            return [redact(v) for v in value]
+        return [redact(value[0])] if value else []
+    return '<{}>'.format(type(value).__name__)
+
+
+def query_shape(command_name, command):
+    shape = {}
+    for field in _SHAPE_FIELDS.get(command_name, ()):
+        if field not in command:
+            continue
+        value = command[field]
+        if field in ('updates', 'deletes'):
+            value = list(value)[:1]
+        shape[field] = value if field in _UNREDACTED_FIELDS else redact(value)
+    return json.dumps(shape, sort_keys=True, default=str)
+
+
+def redact_plan(plan):
+    if isinstance(plan, dict):
+        return dict((k, redact(v) if k in _PLAN_LITERAL_FIELDS else redact_plan(v)) for k, v in plan.items())
+    if isinstance(plan, (list, tuple)):
+        return [redact_plan(v) for v in plan]
+    return plan
+
+
+def _returned(command_name, reply):
+    if 'cursor' in reply:
+        return len(reply['cursor'].get('firstBatch', ()))
+    if command_name == 'distinct':
+        return len(reply.get('values', ()))
+    return reply.get('n')
+
+
+def _find_key(doc, key):
+    if isinstance(doc, dict):
+        if key in doc:
+            return doc[key]
+        values = doc.values()
+    elif isinstance(doc, list):
+        values = doc
+    else:
+        return None
+    for value in values:
+        found = _find_key(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+def plan_summary(plan):
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        if plan.get('indexName'):
+            stage = '{}({})'.format(stage, plan['indexName'])
+        stages.append(stage)
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return ' > '.join(stages)
+
+
+class QueryTrace(object):
+
+    def __init__(self, entrypoint, threshold_ms):
+        self.entrypoint = entrypoint
+        self.threshold_us = threshold_ms * 1000
+        self.pending = {}
+        self.slow = []
+
+    def started(self, event):
+        if event.command_name in _SHAPE_FIELDS:
+            self.pending[event.request_id] = event.command
+
+    def succeeded(self, event):
+        command = self.pending.pop(event.request_id, None)
+        if command is None or event.duration_micros < self.threshold_us:
+            return
+        self.slow.append({
+            'at': datetime.datetime.utcnow(),
+            'entrypoint': self.entrypoint,
+            'command': event.command_name,
+            'database': event.database_name,
+            'collection': command.get(event.command_name),
+            'shape': query_shape(event.command_name, command),
+            'duration_ms': event.duration_micros / 1000.,
+            'docs_returned': _returned(event.command_name, event.reply),
+            'docs_examined': None,
+            'keys_examined': None,
+            'plan_summary': None,
+            '_command': command
+        })
+
+    def failed(self, event):
+        self.pending.pop(event.request_id, None)
+
+
+class SlowQueryListener(monitoring.CommandListener):
+
+    def started(self, event):
+        trace = getattr(_current, 'trace', None)
+        if trace is not None:
+            trace.started(event)
+
+    def succeeded(self, event):
+        trace = getattr(_current, 'trace', None)
+        if trace is not None:
+            trace.succeeded(event)
+
+    def failed(self, event):
+        trace = getattr(_current, 'trace', None)
+        if trace is not None:
+            trace.failed(event)
+
+
+monitoring.register(SlowQueryListener())
+
+
+class SlowQueryRecorder(DependencyProvider):
+
+    def __init__(self, threshold_ms=100, explain_sample_rate=.1, collection_size=16 * 1024 * 1024):
+        self.threshold_ms = threshold_ms
+        self.explain_sample_rate = explain_sample_rate
+        self.collection_size = collection_size
+        self.traces = {}
+        self.collection_ready = False
+
+    def setup(self):
+        config = self.container.config
+        self.threshold_ms = config.get('SLOW_QUERY_THRESHOLD_MS', self.threshold_ms)
+        self.explain_sample_rate = config.get('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', self.explain_sample_rate)
+        self.collection_size = config.get('SLOW_QUERY_COLLECTION_SIZE', self.collection_size)
+
+    def worker_setup(self, worker_ctx):
+        _current.trace = None
+        kind, method_name = entrypoint_key(worker_ctx)
+        if self.threshold_ms is None or kind != 'rpc':
+            return
+        trace = QueryTrace(method_name, self.threshold_ms)
+        self.traces[worker_ctx] = trace
+        _current.trace = trace
+
+    def worker_teardown(self, worker_ctx):
+        _current.trace = None
+        trace = self.traces.pop(worker_ctx, None)
+        if trace is not None and trace.slow:
+            self.container.spawn_managed_thread(lambda: self.record(trace.slow), identifier='slow_queries')
+
+    def _explain(self, database, query):
+        command = query['_command']
+        explained = SON((k, v) for k, v in command.items() if not k.startswith('$') and k not in _SESSION_FIELDS)
+        if query['command'] in ('update', 'delete'):
+            explained[query['command'] + 's'] = list(explained[query['command'] + 's'])[:1]
+        plan = database.client[query['database']].command(
+            SON([('explain', explained), ('verbosity', 'executionStats')]))
+        stats = _find_key(plan, 'executionStats') or {}
+        winning_plan = _find_key(plan, 'winningPlan') or {}
+        query.update({
+            'docs_examined': stats.get('totalDocsExamined'),
+            'keys_examined': stats.get('totalKeysExamined'),
+            'plan_summary': plan_summary(winning_plan),
+            'plan': json.dumps(redact_plan(winning_plan), default=str)
+        })
+
+    def record(self, queries):
+        try:
+            mongo = find_dependency(self.container, MongoDatabase)
+            if mongo is None:
+                return
+            database = mongo.db
+            if not self.collection_ready:
+                try:
+                    database.create_collection('slow_queries', capped=True, size=self.collection_size)
+                except CollectionInvalid:
+                    pass
+                self.collection_ready = True
+
+            for query in queries:
+                _log.warning(f'Slow {query["command"]} on {query["collection"]} from {query["entrypoint"]} '
+                             f'({query["duration_ms"]:.1f}ms): {query["shape"]}')
+                if random.random() < self.explain_sample_rate:
+                    try:
+                        self._explain(database, query)
+                    except PyMongoError as e:
+                        _log.warning(f'Unable to explain slow {query["command"]}: {e}')
+                del query['_command']
+            database.slow_queries.insert_many(queries)
+        except Exception:
+            _log.exception('Unable to record slow queries')
+
+    def get_dependency(self, worker_ctx):
+        return self
@@ -0,0 +1,162 @@
+import logging
+import threading
+import eventlet
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from nameko.extensions import DependencyProvider
+from nameko_mongodb.database import MongoDatabase
+
+from application.dependencies import find_dependency
+from application.dependencies.cache import ResponseCache
+from application.dependencies.outbox import Outbox
+
+
+_log = logging.getLogger(__name__)
+
+
+def _overlaps(path, other):
+    return path.startswith(other + '.') or other.startswith(path + '.')
+
+
+class EntityWriteBuffer(object):
+
+    def __init__(self, window=0.):
+        self.window = window
+        self.ticket = 0
+        self.operations = []
+        self.inflight = []
+        self.last = {}
+        self.errors = []
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    @property
+    def acknowledged(self):
+        tickets = [op['tickets'][0] for op in self.inflight + self.operations]
+        return min(tickets) - 1 if tickets else self.ticket
+
+    def _mergeable(self, operation, set_fields, unset_fields):
+        pending = list(operation['$set']) + list(operation['$unset'])
+        return not any(_overlaps(path, other) for path in list(set_fields) + list(unset_fields) for other in pending)
+
+    def enqueue(self, id, set_fields=None, unset_fields=None):
+        set_fields = set_fields or {}
+        unset_fields = unset_fields or {}
+        with self.lock:
+            self.ticket += 1
+            operation = self.last.get(id)
+            if operation is None or not self._mergeable(operation, set_fields, unset_fields):
+                operation = {'id': id, '$set': {}, '$unset': {}, 'tickets': []}
+                self.operations.append(operation)
+                self.last[id] = operation
+            for path, value in set_fields.items():
+                operation['$unset'].pop(path, None)
+                operation['$set'][path] = value
+            for path in unset_fields:
+                operation['$set'].pop(path, None)
+                operation['$unset'][path] = ''
+            operation['tickets'].append(self.ticket)
+            return self.ticket
+
+    @staticmethod
+    def _update(operation):
+        update = dict((k, operation[k]) for k in ('$set', '$unset') if operation[k])
+        return UpdateOne({'id': operation['id']}, update)
+
+    def flush(self, collection):
+        with self.lock:
+            operations = self.inflight = self.operations
+            self.operations = []
+            self.last = {}
+        result = {'flushed': 0, 'matched': 0, 'modified': 0, 'ids': [], 'changes': [], 'errors': []}
+        try:
+            if not operations:
+                return result
+            processed = len(operations)
+            failed_operations = []
+            try:
+                details = collection.bulk_write([self._update(op) for op in operations], ordered=True).bulk_api_result
+            except BulkWriteError as bwe:
+                details = bwe.details
+                error = details['writeErrors'][0]
+                processed = error['index'] + 1
+                failed = operations[error['index']]
+                failed_operations.append(failed)
+                result['errors'].append({'id': failed['id'], 'tickets': failed['tickets'], 'error': error['errmsg']})
+                self.errors = (self.errors + result['errors'])[-100:]
+            except Exception:
+                processed = 0
+                raise
+            finally:
+                with self.lock:
+                    self.operations = operations[processed:] + self.operations
+                    self.inflight = []
+                    for op in self.operations:
+                        self.last[op['id']] = op
+            result.update({
+                'flushed': processed,
+                'matched': details['nMatched'],
+                'modified': details['nModified'],
+                'ids': list(dict.fromkeys(op['id'] for op in operations[:processed])),
+                'changes': [{'kind': 'entity', 'id': op['id'], 'op': 'update',
+                             'fields': sorted(f for f in list(op['$set']) + list(op['$unset']) if f != 'updated_at')}
+                            for op in operations[:processed] if op not in failed_operations]
+            })
+            return result
+        finally:
+            result['acknowledged'] = self.acknowledged
+
+    def status(self):
+        return {
+            'enabled': self.enabled,
+            'window': self.window,
+            'pending': len(self.operations),
+            'issued': self.ticket,
+            'acknowledged': self.acknowledged,
+            'errors': self.errors
+        }
+
+
+class EntityWriteBuffering(DependencyProvider):
+
+    def __init__(self, window=0.):
+        self.window = window
+        self.buffer = None
+        self.flusher = None
+
+    def setup(self):
+        self.buffer = EntityWriteBuffer(self.container.config.get('ENTITY_WRITE_BUFFER_WINDOW', self.window))
+
+    def start(self):
+        if self.buffer.enabled:
+            self.flusher = self.container.spawn_managed_thread(self._run, identifier='entity_write_buffer')
+
+    def _flush(self):
+        mongo = find_dependency(self.container, MongoDatabase)
+        result = self.buffer.flush(mongo.db.entities)
+        Outbox.record(mongo.db, result.pop('changes'))
+        if result['ids']:
+            cache = find_dependency(self.container, ResponseCache)
+            if cache is not None:
+                cache.cache.invalidate(*(('entity', id) for id in result['ids']))
+        return result
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self.buffer.window)
+            try:
+                self._flush()
+            except Exception:
+                _log.exception('Unable to flush buffered entity writes')
+
+    def stop(self):
+        if self.flusher is not None:
+            self.flusher.kill()
+            self.flusher = None
+            self._flush()
+
+    def get_dependency(self, worker_ctx):
+        return self.buffer
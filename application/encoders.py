@@ -0,0 +1,66 @@
+import base64
+import datetime
+import json
+import bson
+import bson.json_util
+from bson.objectid import ObjectId
+from bson.decimal128 import Decimal128
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+DEFAULT_ENCODING = 'legacy'
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError('Object of type {} is not serializable'.format(type(value).__name__))
+
+
+def _strip_ids(value):
+    # Generated ObjectId keys are internal at any depth, application-assigned _ids (jobs) are kept
+    if isinstance(value, dict):
+        return dict((k, _strip_ids(v)) for k, v in value.items() if not (k == '_id' and isinstance(v, ObjectId)))
+    if isinstance(value, (list, tuple)):
+        return [_strip_ids(v) for v in value]
+    return value
+
+
+def _stripping(dumps):
+    return lambda value: dumps(_strip_ids(value))
+
+
+def _json_dumps(value):
+    return json.dumps(value, default=_default, separators=(',', ':'), ensure_ascii=False)
+
+
+def _bson_dumps(value):
+    return base64.b64encode(bson.BSON.encode({'result': value})).decode('ascii')
+
+
+def _msgpack_dumps(value):
+    return base64.b64encode(msgpack.packb(value, default=_default, use_bin_type=True)).decode('ascii')
+
+
+ENCODERS = {
+    'legacy': bson.json_util.dumps,
+    'json': _stripping(_json_dumps),
+    'bson': _stripping(_bson_dumps)
+}
+
+if msgpack is not None:
+    ENCODERS['msgpack'] = _stripping(_msgpack_dumps)
+
+
+def get_encoder(encoding):
+    return ENCODERS.get(encoding)
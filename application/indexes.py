@@ -0,0 +1,123 @@
+import logging
+from pymongo import TEXT, ASCENDING, DESCENDING
+
+
+_log = logging.getLogger(__name__)
+
+INDEXES_VERSION = 7
+
+INDEXES = {
+    'entities': [
+        {'keys': [('id', ASCENDING), ('allowed_users', ASCENDING)]},
+        {'keys': [('common_name', TEXT)], 'default_language': 'english'},
+        {'keys': [('updated_at', ASCENDING)]}
+    ],
+    'events': [
+        {'keys': [('id', ASCENDING), ('allowed_users', ASCENDING)]},
+        {'keys': [('common_name', TEXT)], 'default_language': 'english'},
+        {'keys': [('updated_at', ASCENDING)]},
+        {'keys': [('date', ASCENDING), ('id', ASCENDING)]},
+        {'keys': [('entities.id', ASCENDING), ('date', DESCENDING), ('id', DESCENDING)]}
+    ],
+    'search': [
+        {'keys': [('ngrams', TEXT), ('prefix_ngrams', TEXT)], 'weights': {'ngrams': 100, 'prefix_ngrams': 200}},
+        {'keys': [('trigrams', ASCENDING)]},
+        {'keys': [('updated_at', ASCENDING)]}
+    ],
+    'labels': [
+        {'keys': [('id', ASCENDING), ('language', ASCENDING), ('context', ASCENDING)], 'unique': True},
+        {'keys': [('version', ASCENDING)]}
+    ],
+    'label_tombstones': [
+        {'keys': [('id', ASCENDING), ('language', ASCENDING), ('context', ASCENDING)], 'unique': True},
+        {'keys': [('version', ASCENDING)]}
+    ],
+    'subscriptions': [
+        {'keys': [('user', ASCENDING)]},
+        {'keys': [('subscription.providers', ASCENDING)]}
+    ],
+    'changes': [
+        {'keys': [('version', ASCENDING)], 'unique': True},
+        {'keys': [('dispatched', ASCENDING), ('version', ASCENDING)]},
+        {'keys': [('at', ASCENDING)], 'expireAfterSeconds': 30 * 24 * 60 * 60}
+    ],
+    'jobs': [
+        {'keys': [('type', ASCENDING), ('user', ASCENDING), ('status', ASCENDING)]}
+    ],
+    'fs.files': [
+        {'keys': [('filename', ASCENDING), ('uploadDate', ASCENDING)]}
+    ],
+    'fs.chunks': [
+        {'keys': [('files_id', ASCENDING), ('n', ASCENDING)], 'unique': True}
+    ]
+}
+
+_META_COLLECTION = 'referential_meta'
+
+
+def index_name(keys):
+    return '_'.join('{}_{}'.format(k, v) for k, v in keys)
+
+
+def _matches(spec, info):
+    if bool(spec.get('unique', False)) != bool(info.get('unique', False)):
+        return False
+
+    text_fields = [k for k, v in spec['keys'] if v == TEXT]
+    if not text_fields:
+        return [(k, v) for k, v in info['key']] == [(k, v) for k, v in spec['keys']]
+
+    weights = spec.get('weights', {})
+    expected = dict((k, weights.get(k, 1)) for k in text_fields)
+    if info.get('weights') != expected:
+        return False
+    return info.get('default_language', 'english') == spec.get('default_language', 'english')
+
+
+def check_indexes(database):
+    report = {}
+    for collection, specs in INDEXES.items():
+        existing = database[collection].index_information()
+        expected = dict((index_name(s['keys']), s) for s in specs)
+
+        missing = [name for name in expected if name not in existing]
+        changed = [name for name, s in expected.items() if name in existing and not _matches(s, existing[name])]
+        extra = [name for name in existing if name != '_id_' and name not in expected]
+
+        report[collection] = {'missing': missing, 'changed': changed, 'extra': extra}
+    return report
+
+
+def ensure_indexes(database, force=False):
+    meta = database[_META_COLLECTION].find_one({'_id': 'indexes'})
+    if not force and meta and meta.get('version') == INDEXES_VERSION:
+        return False
+
+    _log.info(f'Applying index registry version {INDEXES_VERSION} ...')
+    report = check_indexes(database)
+    for collection, specs in INDEXES.items():
+        for spec in specs:
+            name = index_name(spec['keys'])
+            if name in report[collection]['changed']:
+                _log.info(f'Dropping outdated index {name} on {collection} ...')
+                database[collection].drop_index(name)
+            elif name not in report[collection]['missing']:
+                continue
+            options = dict((k, v) for k, v in spec.items() if k != 'keys')
+            database[collection].create_index(spec['keys'], name=name, **options)
+
+        managed = meta.get('indexes', {}).get(collection, []) if meta else []
+        for name in report[collection]['extra']:
+            if name in managed:
+                _log.info(f'Dropping retired index {name} on {collection} ...')
+                database[collection].drop_index(name)
+
+    database[_META_COLLECTION].update_one({'_id': 'indexes'}, {'$set': {
+        'version': INDEXES_VERSION,
+        'indexes': dict((c, [index_name(s['keys']) for s in specs]) for c, specs in INDEXES.items())
+    }}, upsert=True)
+    return True
+
+
+def ensure_indexes_on_setup(provider):
+    ensure_indexes(provider.db)
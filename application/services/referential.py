@@ -1,23 +1,64 @@
 import logging
 import hashlib
 import binascii
-import tempfile
 import base64
 import datetime
-import itertools
 import string
+import time
+import uuid
 from nameko.rpc import rpc
-from nameko.events import event_handler
-from nameko.dependency_providers import DependencyProvider
+from nameko.events import event_handler, EventDispatcher, BROADCAST
+from nameko.web.handlers import http
+from nameko.dependency_providers import DependencyProvider, Config
 from nameko_mongodb.database import MongoDatabase
-from pymongo import TEXT, ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import gridfs
+from gridfs.grid_file import DEFAULT_CHUNK_SIZE
 import bson.json_util
 import dateutil.parser
 
+from application.indexes import ensure_indexes_on_setup, check_indexes
+from application import snapshot
+from application.encoders import get_encoder, DEFAULT_ENCODING
+from application.dependencies.allowed_users import AllowedUsersCache
+from application.dependencies.cache import ResponseCache, PictureCache
+from application.dependencies.jobs import JobRunner
+from application.dependencies.labels import LabelSnapshot
+from application.dependencies.metrics import Metrics, PROMETHEUS_CONTENT_TYPE
+from application.dependencies.slow_queries import SlowQueryRecorder
+from application.dependencies.write_buffer import EntityWriteBuffering
+from application.dependencies.outbox import ChangeRelay
+from application.dependencies.routing import Routing
+from application.dependencies.search_index import SearchIndex, PREFIX_FLAG, hashed_trigrams, query_trigrams
+
 
 _log = logging.getLogger(__name__)
 
+_PICTURE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+    (b'RIFF', 'image/webp'),
+    (b'<svg', 'image/svg+xml'),
+    (b'<?xml', 'image/svg+xml')
+)
+
+_PICTURE_CHUNK_SIZE = 255 * 1024
+
+_BLOB_DELETE_TIMEOUT = 60
+
+_FULL_PROJECTION = {'_id': 0, 'allowed_users': 0}
+
+_VIEWS = {
+    'entities': {
+        'summary': ('id', 'common_name', 'provider', 'type', 'updated_at')
+    },
+    'events': {
+        'summary': ('id', 'date', 'provider', 'type', 'common_name', 'entities.id', 'updated_at')
+    }
+}
+
 
 class ErrorHandler(DependencyProvider):
 
@@ -35,60 +76,402 @@ class ReferentialServiceError(Exception):
 class ReferentialService(object):
     name = 'referential'
 
-    database = MongoDatabase(result_backend=False)
-
-    def _add_provider_subscription(self, user, provider):
-        _log.info(f'Adding {user} subscription to provider: {provider} ...')
-        for collection in ('entities', 'events', 'search'):
-            self.database[collection].update_many({'provider': provider},
-                {'$addToSet':{'allowed_users': user}})
-
-    def _delete_provider_subscription(self, user, providers):
-        _log.info(f'Deleting {user} subscriptions to providers: {providers} ...')
-        for collection in ('entities', 'events', 'search'):
-            self.database[collection].update_many({'provider': {'$in': providers}}, 
-                {'$pull': {'allowed_users': user}})
+    database = MongoDatabase(result_backend=False, on_after_setup=ensure_indexes_on_setup)
+    config = Config()
+    allowed_users_cache = AllowedUsersCache()
+    search_index = SearchIndex()
+    response_cache = ResponseCache()
+    picture_cache = PictureCache()
+    jobs = JobRunner()
+    labels = LabelSnapshot()
+    metrics = Metrics()
+    slow_queries = SlowQueryRecorder()
+    entity_writes = EntityWriteBuffering()
+    outbox = ChangeRelay()
+    routing = Routing()
+    dispatch = EventDispatcher()
+
+    def _add_provider_subscription(self, user, providers, collection):
+        _log.info(f'Adding {user} subscription to providers: {providers} on {collection} ...')
+        return self.database[collection].update_many(
+            {'provider': {'$in': providers}, 'allowed_users': {'$ne': user}},
+            {'$addToSet':{'allowed_users': user}, '$set': {'updated_at': datetime.datetime.utcnow()}}).modified_count
+
+    def _delete_provider_subscription(self, user, providers, collection):
+        _log.info(f'Deleting {user} subscriptions to providers: {providers} on {collection} ...')
+        return self.database[collection].update_many(
+            {'provider': {'$in': providers}, 'allowed_users': user},
+            {'$pull': {'allowed_users': user}, '$set': {'updated_at': datetime.datetime.utcnow()}}).modified_count
+
+    def _subscription_applied(self, user, providers):
+        self.allowed_users_cache.invalidate_user(user, providers)
+        self.response_cache.invalidate(('user', user))
+        self.dispatch('subscription_applied', {'user': user, 'providers': providers})
+
+    def _run_subscription_job(self, job_id):
+        job = self._read('jobs').find_one({'_id': job_id})
+        if not job or job['status'] in ('done', 'superseded'):
+            return
+        # Jobs of the same user can run in other containers: every transition requires the job to still be
+        # running so that a superseded job never applies its stale subscription
+        running = {'_id': job_id, 'status': 'running'}
+        if not self.database.jobs.update_one({'_id': job_id, 'status': {'$in': ['pending', 'running', 'failed']}},
+                {'$set': {'status': 'running', 'updated_at': datetime.datetime.utcnow()}}).matched_count:
+            return
+        user = job['user']
+        try:
+            for i, step in enumerate(job['steps']):
+                if step['done']:
+                    continue
+                if not self._read('jobs').count_documents(running):
+                    _log.info(f'Subscription job {job_id} for {user} superseded, stopping')
+                    return
+                if step['direction'] == 'remove':
+                    modified = self._delete_provider_subscription(user, job['removed'], step['collection'])
+                else:
+                    modified = self._add_provider_subscription(user, job['added'], step['collection'])
+                self.database.jobs.update_one(running, {'$set': {
+                    f'steps.{i}.done': True,
+                    f'steps.{i}.modified': modified,
+                    'progress': (i + 1) / len(job['steps']),
+                    'updated_at': datetime.datetime.utcnow()}})
+            if not self.database.jobs.update_one(running, {'$set': {
+                    'status': 'done', 'updated_at': datetime.datetime.utcnow()}}).matched_count:
+                return
+            self.database.subscriptions.update_one({'user': user},
+                {'$set': {'subscription': job['subscription']}}, upsert=True)
+        except Exception as e:
+            _log.exception(f'Subscription job {job_id} failed for {user}')
+            self.database.jobs.update_one({'_id': job_id, 'status': {'$in': ['running', 'done']}}, {'$set': {
+                'status': 'failed', 'error': str(e), 'updated_at': datetime.datetime.utcnow()}})
+            return
+        self._subscription_applied(user, job['added'] + job['removed'])
 
     @event_handler('subscription_manager', 'user_sub')
     def handle_suscription(self, payload):
         user = payload['user']
-        if 'referential' in payload['subscription']:
-            referential = payload['subscription']['referential']
-            old_sub = self.database.subscriptions.find_one({'user': user})
-            if 'providers' in referential:
-                if old_sub:
-                    old_providers = set([r for r in old_sub['subscription']['providers']])
-                    new_providers = set(referential['providers'])
-                    diff = old_providers - new_providers
-                    self._delete_provider_subscription(user, list(diff))
-                for provider in referential['providers']:
-                    self._add_provider_subscription(user, provider)
+        if 'referential' not in payload['subscription']:
+            return
+        referential = payload['subscription']['referential']
+        old_sub = self._read('subscriptions').find_one({'user': user})
+        old_subscription = old_sub['subscription'] if old_sub else None
+
+        if self._acl_mode() == 'provider':
+            old_providers = set(old_subscription.get('providers', [])) if old_subscription else set()
+            self.database.subscriptions.update_one({'user': user},
+                {'$set': {'subscription': referential}}, upsert=True)
+            self._subscription_applied(user, sorted(old_providers ^ set(referential.get('providers', old_providers))))
+            return
+
+        pending = self._read('jobs').find_one({'type': 'subscription', 'user': user,
+            'status': {'$in': ['pending', 'running', 'failed']}})
+
+        if pending and pending['subscription'] == referential:
+            self.jobs.submit(user, self._run_subscription_job, pending['_id'])
+            return
+        if old_subscription == referential and not pending:
+            return
+
+        old_providers = set(old_subscription.get('providers', [])) if old_subscription else set()
+        new_providers = set(referential.get('providers', old_providers))
+        added = new_providers - old_providers
+        removed = old_providers - new_providers
+        if pending:
+            added.update(new_providers & set(pending['removed']))
+            removed.update(set(pending['added']) - new_providers)
+            self.database.jobs.update_one({'_id': pending['_id'], 'status': {'$in': ['pending', 'running', 'failed']}},
+                {'$set': {'status': 'superseded', 'updated_at': datetime.datetime.utcnow()}})
+
+        if not added and not removed:
             self.database.subscriptions.update_one({'user': user},
                 {'$set': {'subscription': referential}}, upsert=True)
+            self._subscription_applied(user, [])
+            return
+
+        now = datetime.datetime.utcnow()
+        job = {
+            '_id': str(uuid.uuid4()),
+            'type': 'subscription',
+            'user': user,
+            'subscription': referential,
+            'added': sorted(added),
+            'removed': sorted(removed),
+            'steps': [{'collection': c, 'direction': d, 'done': False}
+                      for d, providers in (('remove', removed), ('add', added)) if providers
+                      for c in ('entities', 'events', 'search')],
+            'status': 'pending',
+            'progress': 0.,
+            'created_at': now,
+            'updated_at': now
+        }
+        self.database.jobs.insert_one(job)
+        _log.info(f'Subscription job {job["_id"]} submitted for {user}: +{job["added"]} -{job["removed"]}')
+        self.jobs.submit(user, self._run_subscription_job, job['_id'])
+
+    @event_handler('referential', 'subscription_applied', handler_type=BROADCAST, reliable_delivery=False)
+    def invalidate_subscription_caches(self, payload):
+        self.allowed_users_cache.invalidate_user(payload['user'], payload['providers'])
+        self.response_cache.invalidate(('user', payload['user']))
+
+    @event_handler('referential', 'changes', handler_type=BROADCAST, reliable_delivery=False)
+    def invalidate_changed_entries(self, payload):
+        self.response_cache.invalidate(*((c['kind'], c['id']) for c in payload['changes']
+                                         if c['kind'] in ('entity', 'event')))
+
+    @staticmethod
+    def _change(kind, id, op, fields=()):
+        return {'kind': kind, 'id': id, 'op': op,
+                'fields': sorted(f for f in fields if f not in ('allowed_users', 'updated_at'))}
+
+    def _read(self, collection):
+        return self.routing.collection(self.database, collection)
+
+    def _read_database(self):
+        return self.routing.database(self.database)
+
+    def _record_changes(self, changes):
+        return self.outbox.record(self.database, changes)
+
+    @rpc
+    def get_changes_since(self, version, limit=1000, encoding=None):
+        changes = self.outbox.since(self._read('changes'), version, limit)
+        return self._encode({
+            'changes': changes,
+            'version': changes[-1]['version'] if changes else version,
+            'latest': self.outbox.latest(self._read_database())
+        }, encoding)
+
+    @rpc
+    def relay_changes(self):
+        return self.outbox.relay(self.database, self.dispatch)
+
+    @rpc
+    def get_job(self, job_id, encoding=None):
+        return self._encode(self._read('jobs').find_one({'_id': job_id}), encoding)
+
+    @rpc
+    def resume_jobs(self):
+        jobs = list(self._read('jobs').find(
+            {'type': 'subscription', 'status': {'$in': ['pending', 'running', 'failed']}}, {'user': 1}))
+        for job in jobs:
+            self.jobs.submit(job['user'], self._run_subscription_job, job['_id'])
+        return [job['_id'] for job in jobs]
+
+    @rpc
+    def get_allowed_users_cache_stats(self):
+        return self.allowed_users_cache.stats()
+
+    @rpc
+    def get_response_cache_stats(self):
+        return self.response_cache.stats()
+
+    @rpc
+    def get_metrics(self):
+        return self.metrics.snapshot()
+
+    @http('GET', '/metrics')
+    def export_metrics(self, request):
+        return 200, {'Content-Type': PROMETHEUS_CONTENT_TYPE}, self.metrics.render()
+
+    @rpc
+    def get_slow_queries(self, limit=20, since=None, encoding=None):
+        match = {'at': {'$gte': dateutil.parser.parse(since)}} if since else {}
+        cursor = self._read('slow_queries').aggregate([
+            {'$match': match},
+            {'$group': {
+                '_id': {'entrypoint': '$entrypoint', 'command': '$command', 'collection': '$collection',
+                        'shape': '$shape'},
+                'count': {'$sum': 1},
+                'total_ms': {'$sum': '$duration_ms'},
+                'max_ms': {'$max': '$duration_ms'},
+                'docs_returned': {'$avg': '$docs_returned'},
+                'docs_examined': {'$max': '$docs_examined'},
+                'keys_examined': {'$max': '$keys_examined'},
+                'plan_summary': {'$max': '$plan_summary'},
+                'last_seen': {'$max': '$at'}
+            }},
+            {'$sort': {'total_ms': -1}},
+            {'$limit': limit}
+        ])
+        return self._encode([dict(r.pop('_id'), **r) for r in cursor], encoding)
+
+    def _encode(self, result, encoding=None):
+        encoding = encoding or self.config.get('RESPONSE_ENCODING', DEFAULT_ENCODING)
+        encoder = get_encoder(encoding)
+        if encoder is None:
+            raise ReferentialServiceError('Unsupported response encoding {}'.format(encoding))
+        return encoder(result)
+
+    def _projection(self, collection, view, full=_FULL_PROJECTION):
+        if view is None or view == 'full':
+            return full
+        fields = _VIEWS[collection].get(view) if isinstance(view, str) else view
+        if fields is None:
+            raise ReferentialServiceError('Unknown view {}'.format(view))
+        fields = [f for f in fields if f.split('.')[0] not in ('_id', 'allowed_users')]
+        if not fields:
+            raise ReferentialServiceError('Empty view {}'.format(view))
+        return dict({'_id': 0}, **dict((f, 1) for f in fields))
+
+    def _cached_find_one(self, kind, collection, id, user, encoding, view=None):
+        projection = self._projection(collection, view)
+        key = (kind, id, user, encoding, view if view is None or isinstance(view, str) else tuple(view))
+        result = self.response_cache.get(key)
+        if result is None:
+            doc = self._read(collection).find_one(dict({'id': id}, **self._acl_filter(user)), projection)
+            result = self._encode(doc, encoding)
+            self.response_cache.set(key, result, tags=((kind, id), ('user', user)))
+        return result
+
+    @rpc
+    def check_indexes(self):
+        return check_indexes(self.database)
+
+    @rpc
+    def export_snapshot(self, path, collections=None):
+        with open(path, 'wb') as stream:
+            return snapshot.export_snapshot(self.database, stream, collections or snapshot.COLLECTIONS)
+
+    @rpc
+    def import_snapshot(self, path, drop=True, workers=4):
+        try:
+            with open(path, 'rb') as stream:
+                result = snapshot.import_snapshot(self.database, stream, drop, workers)
+        except snapshot.SnapshotError as e:
+            raise ReferentialServiceError(str(e))
+        self.response_cache.clear()
+        self.picture_cache.clear()
+        self.allowed_users_cache.clear()
+        self.labels.clear()
+        self.search_index.clear()
+        return result
 
     @staticmethod
     def _filename(_type, entity_id, context_id, format_id):
         concat = ''.join([_type, entity_id, context_id, format_id])
         return hashlib.sha1(concat.encode('utf-8')).hexdigest()
 
-    def _add_file_to_gridfs(self, filename, content, is_base64=False):
-        fs = gridfs.GridFS(self.database)
-
-        file = fs.find_one({'filename': filename})
+    @staticmethod
+    def _content_type(data, is_base64):
+        for signature, content_type in _PICTURE_SIGNATURES:
+            if data.startswith(signature):
+                return content_type
+        return 'application/octet-stream' if is_base64 else 'text/plain; charset=utf-8'
+
+    def _write_chunks(self, digest, data):
+        chunks = [UpdateOne({'files_id': digest, 'n': n},
+                            {'$setOnInsert': {'data': bson.Binary(data[offset:offset + DEFAULT_CHUNK_SIZE])}}, upsert=True)
+                  for n, offset in enumerate(range(0, len(data), DEFAULT_CHUNK_SIZE))]
+        if not chunks:
+            return
+        try:
+            self.database.fs.chunks.bulk_write(chunks, ordered=False)
+        except BulkWriteError as bwe:
+            if any(e['code'] != 11000 for e in bwe.details['writeErrors']):
+                raise
+
+    def _delete_blob(self, digest, marker):
+        self.database.fs.chunks.delete_many({'files_id': digest})
+        self.database.fs.files.delete_one({'_id': digest, 'metadata.deleting': marker})
+
+    def _store_blob(self, data, is_base64):
+        # The files document is claimed before its chunks are written and chunks are only deleted once it is
+        # flagged as deleting, so concurrent uploads of the same content never remove each other's chunks.
+        files = self.database.fs.files
+        digest = hashlib.sha256(data).hexdigest()
+        while True:
+            file = files.find_one_and_update({'_id': digest, 'metadata.deleting': {'$exists': False}},
+                {'$inc': {'metadata.refs': 1}}, projection={'metadata': 1}, return_document=ReturnDocument.AFTER)
+            if file is None:
+                file = {'_id': digest, 'filename': digest, 'contentType': self._content_type(data, is_base64),
+                        'length': len(data), 'chunkSize': DEFAULT_CHUNK_SIZE, 'uploadDate': datetime.datetime.utcnow(),
+                        'metadata': {'encoding': 'raw', 'refs': 1, 'pending': True}}
+                try:
+                    files.insert_one(file)
+                except DuplicateKeyError:
+                    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=_BLOB_DELETE_TIMEOUT)
+                    abandoned = self._read('fs.files').find_one({'_id': digest, 'metadata.deleting': {'$lt': stale}},
+                        {'metadata': 1})
+                    if abandoned:
+                        marker = datetime.datetime.utcnow()
+                        if files.update_one({'_id': digest, 'metadata.deleting': abandoned['metadata']['deleting']},
+                                {'$set': {'metadata.deleting': marker}}).matched_count:
+                            self._delete_blob(digest, marker)
+                    else:
+                        time.sleep(.05)
+                    continue
+            if file['metadata'].get('pending'):
+                self._write_chunks(digest, data)
+                files.update_one({'_id': digest}, {'$unset': {'metadata.pending': ''}})
+            return digest
+
+    def _release_blob(self, digest):
+        files = self.database.fs.files
+        files.update_one({'_id': digest}, {'$inc': {'metadata.refs': -1}})
+        marker = datetime.datetime.utcnow()
+        if files.update_one({'_id': digest, 'metadata.refs': {'$lte': 0}, 'metadata.deleting': {'$exists': False}},
+                {'$set': {'metadata.deleting': marker}}).matched_count:
+            self._delete_blob(digest, marker)
+
+    def _link_picture(self, filename, digest, **keys):
+        keys.update({'blob': digest, 'updated_at': datetime.datetime.utcnow()})
+        previous = self.database.pictures.find_one_and_update({'_id': filename}, {'$set': keys}, upsert=True)
+        if previous and previous['blob'] == digest:
+            self._release_blob(digest)
+        elif previous:
+            self._release_blob(previous['blob'])
+
+    def _add_file_to_gridfs(self, filename, content, is_base64=False, **keys):
+        data = base64.b64decode(content) if is_base64 is True else content.encode('utf-8')
+        self._link_picture(filename, self._store_blob(data, is_base64), **keys)
+        self._delete_legacy_file(filename)
+
+    def _read_blob(self, digest):
+        cached = self.picture_cache.get(digest)
+        if cached is None:
+            file = gridfs.GridFS(self._read_database()).get(digest)
+            cached = (file.content_type, file.read())
+            self.picture_cache.set(digest, cached)
+        return cached
+
+    def _read_picture(self, filename, is_base64):
+        picture = self._read('pictures').find_one({'_id': filename}, {'blob': 1, 'updated_at': 1})
+        if picture:
+            try:
+                content_type, data = self._read_blob(picture['blob'])
+            except gridfs.errors.NoFile:
+                return None
+            return {'hash': picture['blob'], 'last_modified': picture['updated_at'],
+                    'content_type': content_type, 'data': data}
+
+        file = gridfs.GridFS(self._read_database()).find_one({'filename': filename})
+        if not file:
+            return None
+        data = self._read_file(file, is_base64)
+        return {'hash': hashlib.sha256(data).hexdigest(), 'last_modified': file.upload_date,
+                'content_type': file.content_type, 'data': data}
+
+    def _find_file(self, filename):
+        fs = gridfs.GridFS(self._read_database())
+        picture = self._read('pictures').find_one({'_id': filename}, {'blob': 1})
+        if picture:
+            try:
+                return fs.get(picture['blob'])
+            except gridfs.errors.NoFile:
+                return None
+        return fs.find_one({'filename': filename})
 
-        if file:
-            fs.delete(file._id)
+    @staticmethod
+    def _is_legacy_file(file):
+        return not file.metadata or file.metadata.get('encoding') != 'raw'
 
-        with tempfile.TemporaryFile() as f:
-            if is_base64 is True:
-                f.write(binascii.hexlify(base64.b64decode(content)))
-            else:
-                f.write(content.encode('utf-8'))
-            f.flush()
-            f.seek(0)
-            fs.put(f, filename=filename)
+    def _read_file(self, file, is_base64):
+        data = file.read()
+        if is_base64 and self._is_legacy_file(file):
+            return binascii.unhexlify(data)
+        return data
 
-    def _delete_file_from_gridfs(self, filename):
+    def _delete_legacy_file(self, filename):
         fs = gridfs.GridFS(self.database)
 
         file = fs.find_one({'filename': filename})
@@ -96,117 +479,326 @@ class ReferentialService(object):
         if file:
             fs.delete(file._id)
 
+    def _delete_file_from_gridfs(self, filename):
+        picture = self.database.pictures.find_one_and_delete({'_id': filename})
+        if picture:
+            self._release_blob(picture['blob'])
+        self._delete_legacy_file(filename)
+
     def _get_allowed_users(self, provider):
-        sub = self.database.subscriptions.find({'subscription.providers': provider}, {'user': 1})
-        return [r['user'] for r in sub]
+        return self._get_allowed_users_by_provider([provider])[provider]
+
+    def _get_allowed_users_by_provider(self, providers):
+        allowed_users, missing = self.allowed_users_cache.get_many(providers)
+        if not missing:
+            return allowed_users
+
+        loaded = dict((p, []) for p in missing)
+        sub = self._read('subscriptions').find({'subscription.providers': {'$in': missing}},
+            {'user': 1, 'subscription.providers': 1})
+        for r in sub:
+            for provider in r['subscription']['providers']:
+                if provider in loaded:
+                    loaded[provider].append(r['user'])
+        for provider, users in loaded.items():
+            self.allowed_users_cache.set(provider, users)
+        allowed_users.update(loaded)
+        return allowed_users
+
+    def _acl_mode(self):
+        return self.config.get('ACL_MODE', 'denormalized')
+
+    def _get_user_providers(self, user):
+        providers = self.allowed_users_cache.get_user_providers(user)
+        if providers is None:
+            sub = self._read('subscriptions').find_one({'user': user}, {'subscription.providers': 1})
+            providers = sorted(sub.get('subscription', {}).get('providers', [])) if sub else []
+            self.allowed_users_cache.set_user_providers(user, providers)
+        return providers
+
+    def _acl_filter(self, user, provider=None):
+        if self._acl_mode() == 'provider':
+            providers = self._get_user_providers(user)
+            if provider is not None:
+                providers = [provider] if provider in providers else []
+            return {'provider': {'$in': providers}}
+
+        acl = {'allowed_users': user}
+        if provider is not None:
+            acl['provider'] = provider
+        return acl
+
+    def _denormalized_acl(self, provider):
+        if self._acl_mode() == 'provider':
+            return {}
+        return {'allowed_users': self._get_allowed_users(provider)}
 
     @rpc
-    def add_entity(self, id, common_name, provider, type, informations = None):
-        self.database.entities.create_index([('id', ASCENDING), ('allowed_users', ASCENDING)])
-        self.database.entities.create_index([('common_name', TEXT)], default_language='english')
+    def migrate_acl_mode(self, mode='provider'):
+        if mode not in ('denormalized', 'provider'):
+            raise ReferentialServiceError('Unknown ACL mode {}'.format(mode))
+        if mode != self._acl_mode():
+            raise ReferentialServiceError('ACL_MODE must be set to {} before migrating'.format(mode))
+
+        self.allowed_users_cache.clear()
+        self.response_cache.clear()
+        migrated = {}
+        for collection in ('entities', 'events', 'search'):
+            if mode == 'provider':
+                migrated[collection] = self.database[collection].update_many(
+                    {'allowed_users': {'$exists': True}}, {'$unset': {'allowed_users': ''}}).modified_count
+            else:
+                allowed_users = self._get_allowed_users_by_provider(self._read(collection).distinct('provider'))
+                now = datetime.datetime.utcnow()
+                migrated[collection] = sum(self.database[collection].update_many({'provider': provider},
+                    {'$set': {'allowed_users': users, 'updated_at': now}}).modified_count
+                    for provider, users in allowed_users.items())
+            _log.info(f'{migrated[collection]} {collection} documents migrated to {mode} ACL mode')
+        return migrated
+
+    @rpc
+    def compare_acl_modes(self, user, samples=20):
+        start = time.monotonic()
+        sub = self._read('subscriptions').find_one({'user': user}, {'subscription.providers': 1})
+        providers = sorted(sub.get('subscription', {}).get('providers', [])) if sub else []
+        resolve = time.monotonic() - start
+
+        filters = {'denormalized': {'allowed_users': user}, 'provider': {'provider': {'$in': providers}}}
+        report = {'user': user, 'providers': len(providers), 'resolve_ms': resolve * 1000, 'collections': {}}
+        for collection in ('entities', 'events', 'search'):
+            stats = self.database.command('collStats', collection)
+            arrays = list(self._read(collection).aggregate([
+                {'$match': {'allowed_users': {'$exists': True}}},
+                {'$group': {'_id': None, 'documents': {'$sum': 1}, 'entries': {'$sum': {'$size': '$allowed_users'}}}}
+            ]))
+            entry = {
+                'documents': stats.get('count', 0),
+                'size': stats.get('size', 0),
+                'index_size': stats.get('totalIndexSize', 0),
+                'allowed_users_index_size': sum(size for name, size in stats.get('indexSizes', {}).items()
+                                                if 'allowed_users' in name),
+                'allowed_users_documents': arrays[0]['documents'] if arrays else 0,
+                'allowed_users_entries': arrays[0]['entries'] if arrays else 0
+            }
+            for mode, query in filters.items():
+                timings = []
+                for _ in range(samples):
+                    start = time.monotonic()
+                    list(self._read(collection).find(query, {'id': 1, '_id': 0}).limit(100))
+                    timings.append((time.monotonic() - start) * 1000)
+                timings.sort()
+                entry[mode] = {
+                    'matched': self._read(collection).count_documents(query),
+                    'p50_ms': timings[len(timings) // 2] if timings else None,
+                    'max_ms': timings[-1] if timings else None
+                }
+            report['collections'][collection] = entry
+        return report
+
+    def _bulk_upsert(self, collection, kind, records, make_update):
+        results = [{'id': r.get('id') if isinstance(r, dict) else None, 'status': 'ok'} for r in records]
+        denormalized = self._acl_mode() == 'denormalized'
+        allowed_users = self._get_allowed_users_by_provider(
+            set(r['provider'] for r in records if isinstance(r, dict) and isinstance(r.get('provider'), str))
+        ) if denormalized else {}
+
+        operations = []
+        positions = []
+        changes = {}
+        now = datetime.datetime.utcnow()
+        for i, record in enumerate(records):
+            try:
+                if not isinstance(record.get('id'), (str, int)):
+                    raise ValueError('Record id must be a string or an integer')
+                if not isinstance(record.get('provider'), str):
+                    raise ValueError('Record provider must be a string')
+                update = make_update(record)
+                if denormalized:
+                    update['allowed_users'] = allowed_users[record['provider']]
+                update['updated_at'] = now
+            except Exception as e:
+                results[i].update({'status': 'error', 'error': '{}: {}'.format(type(e).__name__, e)})
+                if not isinstance(results[i]['id'], (str, int)):
+                    results[i]['id'] = None
+                continue
+            operations.append(UpdateOne({'id': record['id']}, {'$set': update}, upsert=True))
+            positions.append(i)
+            changes[i] = self._change(kind, record['id'], 'upsert', update)
+
+        if operations:
+            try:
+                self.database[collection].bulk_write(operations, ordered=False)
+            except BulkWriteError as bwe:
+                for error in bwe.details['writeErrors']:
+                    results[positions[error['index']]].update({'status': 'error', 'error': error['errmsg']})
+                    del changes[positions[error['index']]]
+            self._record_changes([changes[i] for i in sorted(changes)])
+
+        return results
 
+    @rpc
+    def add_entity(self, id, common_name, provider, type, informations = None):
         update = {
             'common_name': common_name,
             'provider': provider,
             'type': type,
-            'allowed_users': self._get_allowed_users(provider)
+            'updated_at': datetime.datetime.utcnow()
         }
+        update.update(self._denormalized_acl(provider))
         if informations:
             update.update({'informations': informations})
 
         self.database.entities.update_one(
             {'id': id}, {'$set': update}, upsert=True)
 
+        self.response_cache.invalidate(('entity', id))
+        self._record_changes([self._change('entity', id, 'upsert', update)])
+
         return {'id': id}
 
+    @rpc
+    def add_entities_bulk(self, entities):
+        def make_update(record):
+            update = {
+                'common_name': record['common_name'],
+                'provider': record['provider'],
+                'type': record['type']
+            }
+            if record.get('informations'):
+                update['informations'] = record['informations']
+            return update
+
+        results = self._bulk_upsert('entities', 'entity', entities, make_update)
+        self.response_cache.invalidate(*(('entity', r['id']) for r in results))
+        return results
+
+    def _mutate_entity(self, id, set_fields=None, unset_fields=None, must_exist=False):
+        set_fields = dict(set_fields or {}, updated_at=datetime.datetime.utcnow())
+        if self.entity_writes.enabled:
+            return {'ticket': self.entity_writes.enqueue(id, set_fields, unset_fields)}
+
+        update = {'$set': set_fields}
+        if unset_fields:
+            update['$unset'] = unset_fields
+        matched = self.database.entities.update_one({'id': id}, update).matched_count
+
+        if must_exist and not matched:
+            raise ReferentialServiceError('Entity not found with id {}'.format(id))
+
+        self.response_cache.invalidate(('entity', id))
+        if matched:
+            self._record_changes([self._change('entity', id, 'update', list(set_fields) + list(unset_fields or {}))])
+
+        return {}
+
     @rpc
     def add_informations_to_entity(self, id, informations):
         update_doc = dict(('informations.{}'.format(k), v)
                           for k, v in informations.items())
 
-        self.database.entities.update_one(
-            {'id': id},
-            {'$set': update_doc}
-        )
-
-        return {'id': id}
+        return dict(self._mutate_entity(id, update_doc), id=id)
 
     @rpc
     def add_translation_to_entity(self, id, language, translation):
-        entity = self.database.entities.find_one({'id': id}, {'id': 1, 'internationalization': 1})
-
-        if not entity:
-            raise ReferentialServiceError('Entity not found with id {}'.format(id))
-
-        if 'internationalization' not in entity:
-            entity['internationalization'] = {language: translation}
-        else:
-            entity['internationalization'][language] = translation
-
-        self.database.entities.update_one(
-            {'id': id},
-            {'$set': {'internationalization': entity['internationalization']}})
-
-        return {'id': id, 'language': language}
+        return dict(self._mutate_entity(id, {'internationalization.{}'.format(language): translation}, must_exist=True),
+                    id=id, language=language)
 
     @rpc
     def delete_translation_from_entity(self, id, language):
-        self.database.entities.update_one({'id': id}, {'$unset': {'internationalization': {language: ''}}})
-
-        return {'id': id, 'language': language}
+        return dict(self._mutate_entity(id, unset_fields={'internationalization.{}'.format(language): ''}),
+                    id=id, language=language)
 
     @rpc
     def add_multiline_to_entity(self, id, multiline):
-        entity = self.database.entities.find_one({'id': id}, {'id': 1, 'multiline': 1})
-
-        if not entity:
-            raise ReferentialServiceError('Entity not found with id {}'.format(id))
+        return dict(self._mutate_entity(id, {'multiline': multiline}, must_exist=True), id=id)
 
-        self.database.entities.update_one({'id': id}, {'$set': {'multiline': multiline}})
-
-        return {'id': id}
-
-    @rpc 
+    @rpc
     def delete_multiline_from_entity(self, id):
-        self.database.entities.update_one({'id': id}, {'$unset': {'multiline': ''}})
+        return dict(self._mutate_entity(id, unset_fields={'multiline': ''}), id=id)
 
-        return {'id': id}
+    @rpc
+    def flush_entity_writes(self):
+        result = self.entity_writes.flush(self.database.entities)
+        self.response_cache.invalidate(*(('entity', id) for id in result['ids']))
+        self._record_changes(result.pop('changes'))
+        return result
+
+    @rpc
+    def get_entity_write_buffer_status(self):
+        return self.entity_writes.status()
 
     @rpc
     def add_picture_to_entity(self, id, context, format, content, kind='bitmap'):
         filename = self._filename(kind, id, context, format)
+        keys = {'kind': kind, 'id': id, 'context': context, 'format': format}
         if kind == 'bitmap':
-            self._add_file_to_gridfs(filename, content, is_base64=True)
+            self._add_file_to_gridfs(filename, content, is_base64=True, **keys)
         else:
-            self._add_file_to_gridfs(filename, content)
+            self._add_file_to_gridfs(filename, content, **keys)
+        self._record_changes([self._change('picture', id, 'upsert', ['{}/{}/{}'.format(kind, context, format)])])
         return {'id': id, 'context': context, 'format': format}
 
     @rpc
     def delete_picture_from_entity(self, id, context, format, kind='bitmap'):
         filename = self._filename(kind, id, context, format)
         self._delete_file_from_gridfs(filename)
+        self._record_changes([self._change('picture', id, 'delete', ['{}/{}/{}'.format(kind, context, format)])])
         return {'id': id, 'context': context, 'format': format}
 
     @rpc
-    def get_entity_by_id(self, id, user):
-        entity = self.database.entities.find_one({'id': id, 'allowed_users': user}, 
-            {'_id': 0, 'allowed_users': 0})
-        return bson.json_util.dumps(entity)
+    def get_entity_by_id(self, id, user, encoding=None, view=None):
+        return self._cached_find_one('entity', 'entities', id, user, encoding, view)
+
+    @staticmethod
+    def _encode_page_token(key):
+        return base64.urlsafe_b64encode(bson.BSON.encode(key)).decode('ascii')
+
+    @staticmethod
+    def _decode_page_token(token):
+        try:
+            return bson.BSON(base64.urlsafe_b64decode(token.encode('ascii'))).decode()
+        except Exception:
+            raise ReferentialServiceError('Invalid page token {}'.format(token))
+
+    def _paginate(self, collection, query, projection, sort, page_size, page_token, encoding):
+        if not isinstance(page_size, int) or isinstance(page_size, bool) or page_size < 1:
+            raise ReferentialServiceError('Invalid page size {}'.format(page_size))
+        if 1 in projection.values():
+            projection = dict(projection, **dict((f, 1) for f, _ in sort))
+        if page_token is not None:
+            key = self._decode_page_token(page_token)
+            clauses = []
+            for i, (field, direction) in enumerate(sort):
+                clause = dict((f, key[f]) for f, _ in sort[:i])
+                clause[field] = {'$gt' if direction == ASCENDING else '$lt': key[field]}
+                clauses.append(clause)
+            query = dict(query, **{'$or': clauses})
+
+        items = list(self._read(collection).find(query, projection).sort(sort).limit(page_size + 1))
+        next_token = None
+        if len(items) > page_size:
+            items = items[:page_size]
+            next_token = self._encode_page_token(dict((f, items[-1].get(f)) for f, _ in sort))
+        return self._encode({'items': items, 'next_token': next_token}, encoding)
 
     @rpc
-    def get_entities_by_name(self, name, user):
-        cursor = self.database.entities.find({'$text': {'$search': name}, 'allowed_users':user}, 
-            {'_id': 0, 'allowed_users': 0})
-        return bson.json_util.dumps(list(cursor))
+    def get_entities_by_name(self, name, user, page_size=None, page_token=None, encoding=None, view=None):
+        query = dict({'$text': {'$search': name}}, **self._acl_filter(user))
+        projection = self._projection('entities', view)
+        if page_size is not None:
+            return self._paginate('entities', query, projection,
+                [('id', ASCENDING)], page_size, page_token, encoding)
+        cursor = self._read('entities').find(query, projection)
+        return self._encode(list(cursor), encoding)
 
     def _check_gridfs_access(self, id, context, user):
-        sub = self.database.subscriptions.find_one({
+        sub = self._read('subscriptions').find_one({
             'user': user, 
             'subscription.pictures': context
         })
         if not sub:
             return False
-        entity = self.database.entities.find_one({'id': id, 'allowed_users': user})
+        entity = self._read('entities').find_one(dict({'id': id}, **self._acl_filter(user)), {'_id': 1})
         if not entity:
             return False
         return True
@@ -215,43 +807,187 @@ class ReferentialService(object):
     def get_entity_picture(self, id, context, format, user, kind='bitmap'):
         if not self._check_gridfs_access(id, context, user):
             return None
-        fs = gridfs.GridFS(self.database)
+        picture = self._read_picture(self._filename(kind, id, context, format), kind == 'bitmap')
+
+        if not picture:
+            return None
+        
+        if kind == 'bitmap':
+            return base64.b64encode(picture['data']).decode('utf-8')
+
+        return picture['data'].decode('utf-8')
+
+    @rpc
+    def get_entity_picture_if_modified(self, id, context, format, user, known_hash=None, kind='bitmap'):
+        if not self._check_gridfs_access(id, context, user):
+            return None
         filename = self._filename(kind, id, context, format)
 
-        file = fs.find_one({'filename': filename})
+        if known_hash is not None:
+            picture = self._read('pictures').find_one({'_id': filename}, {'blob': 1})
+            if picture and picture['blob'] == known_hash:
+                return {'status': 'not_modified', 'hash': known_hash}
 
-        if not file:
+        picture = self._read_picture(filename, kind == 'bitmap')
+        if not picture:
             return None
-        
+        if picture['hash'] == known_hash:
+            return {'status': 'not_modified', 'hash': known_hash}
+
         if kind == 'bitmap':
-            return base64.b64encode(binascii.unhexlify(file.read())).decode('utf-8')
+            content = base64.b64encode(picture['data']).decode('utf-8')
+        else:
+            content = picture['data'].decode('utf-8')
+
+        return {
+            'status': 'ok',
+            'hash': picture['hash'],
+            'last_modified': picture['last_modified'].isoformat(),
+            'content_type': picture['content_type'],
+            'content': content
+        }
 
-        return file.read().decode('utf-8')
+    @rpc
+    def get_picture_cache_stats(self):
+        return self.picture_cache.stats()
 
     @rpc
-    def add_event(self, id, date, provider, type, common_name, content, entities):
-        self.database.events.create_index([('id', ASCENDING), ('allowed_users', ASCENDING)])
-        self.database.events.create_index([('common_name', TEXT)], default_language='english')
+    def get_entity_pictures(self, requests, user):
+        requests = [dict(r, kind=r.get('kind', 'bitmap')) for r in requests]
+        results = dict(('{kind}/{id}/{context}/{format}'.format(**r), None) for r in requests)
+
+        sub = self._read('subscriptions').find_one({'user': user}, {'subscription.pictures': 1})
+        contexts = set(sub.get('subscription', {}).get('pictures', [])) if sub else set()
+        requests = [r for r in requests if r['context'] in contexts]
+        if not requests:
+            return results
+
+        visible = set(e['id'] for e in self._read('entities').find(
+            dict({'id': {'$in': list(set(r['id'] for r in requests))}}, **self._acl_filter(user)),
+            {'id': 1, '_id': 0}))
+        requests = dict((self._filename(r['kind'], r['id'], r['context'], r['format']), r)
+            for r in requests if r['id'] in visible)
+        if not requests:
+            return results
+
+        blobs = dict((p['_id'], p['blob']) for p in self._read('pictures').find(
+            {'_id': {'$in': list(requests)}}, {'blob': 1}))
+        legacy = [f for f in requests if f not in blobs]
+        files = {}
+        for doc in self._read('fs.files').find(
+                {'$or': [{'_id': {'$in': list(set(blobs.values()))}}, {'filename': {'$in': legacy}}]},
+                {'filename': 1, 'metadata': 1}).sort('uploadDate', ASCENDING):
+            files[doc['_id']] = doc
+            if doc['filename'] in legacy:
+                blobs[doc['filename']] = doc['_id']
+
+        contents = dict((file_id, []) for file_id in files)
+        for chunk in self._read('fs.chunks').find({'files_id': {'$in': list(files)}}).sort(
+                [('files_id', ASCENDING), ('n', ASCENDING)]):
+            contents[chunk['files_id']].append(chunk['data'])
+
+        for filename, r in requests.items():
+            file_id = blobs.get(filename)
+            if file_id not in files:
+                continue
+            data = b''.join(contents[file_id])
+            if r['kind'] == 'bitmap':
+                if (files[file_id].get('metadata') or {}).get('encoding') != 'raw':
+                    data = binascii.unhexlify(data)
+                content = base64.b64encode(data).decode('utf-8')
+            else:
+                content = data.decode('utf-8')
+            results['{kind}/{id}/{context}/{format}'.format(**r)] = content
+
+        return results
+
+    @rpc
+    def get_entity_picture_chunk(self, id, context, format, user, offset=0, size=_PICTURE_CHUNK_SIZE, kind='bitmap'):
+        if not self._check_gridfs_access(id, context, user):
+            return None
+        file = self._find_file(self._filename(kind, id, context, format))
+
+        if not file:
+            return None
+
+        if kind == 'bitmap' and self._is_legacy_file(file):
+            length = file.length // 2
+            file.seek(2 * offset)
+            data = binascii.unhexlify(file.read(2 * size))
+        else:
+            length = file.length
+            file.seek(offset)
+            data = file.read(size)
+
+        return {
+            'content': base64.b64encode(data).decode('utf-8'),
+            'content_type': file.content_type,
+            'offset': offset,
+            'length': length,
+            'eof': offset + len(data) >= length
+        }
 
+    @rpc
+    def migrate_pictures(self, batch_size=100):
+        fs = gridfs.GridFS(self.database)
+        migrated = 0
+        while True:
+            files = list(self._read('fs.files').find({'metadata.refs': {'$exists': False}}).limit(batch_size))
+            if not files:
+                break
+            for doc in files:
+                file = fs.get(doc['_id'])
+                data = file.read()
+                is_base64 = not (file.content_type or 'text/').startswith('text/')
+                if self._is_legacy_file(file):
+                    try:
+                        data = binascii.unhexlify(data)
+                        is_base64 = True
+                    except (binascii.Error, ValueError):
+                        pass
+                self._link_picture(doc['filename'], self._store_blob(data, is_base64))
+                fs.delete(doc['_id'])
+                migrated += 1
+            _log.info(f'{migrated} pictures migrated to content-addressed storage ...')
+        return migrated
+
+    @rpc
+    def add_event(self, id, date, provider, type, common_name, content, entities):
         p_date = dateutil.parser.parse(date)
+        update = {
+            'date': p_date,
+            'provider': provider,
+            'type': type,
+            'common_name': common_name,
+            'content': content,
+            'entities': entities,
+            'updated_at': datetime.datetime.utcnow()
+        }
+        update.update(self._denormalized_acl(provider))
 
-        self.database.events.update_one(
-            {'id': id},
-            {
-                '$set': {
-                    'date': p_date,
-                    'provider': provider,
-                    'type': type,
-                    'common_name': common_name,
-                    'content': content,
-                    'entities': entities,
-                    'allowed_users': self._get_allowed_users(provider)
-                }
-            }, upsert=True
-        )
+        self.database.events.update_one({'id': id}, {'$set': update}, upsert=True)
+
+        self.response_cache.invalidate(('event', id))
+        self._record_changes([self._change('event', id, 'upsert', update)])
 
         return {'id': id, 'date': date, 'provider': provider, 'type': type, 'common_name': common_name}
 
+    @rpc
+    def add_events_bulk(self, events):
+        def make_update(record):
+            return {
+                'date': dateutil.parser.parse(record['date']),
+                'provider': record['provider'],
+                'type': record['type'],
+                'common_name': record['common_name'],
+                'content': record['content'],
+                'entities': record['entities']
+            }
+
+        results = self._bulk_upsert('events', 'event', events, make_update)
+        self.response_cache.invalidate(*(('event', r['id']) for r in results))
+        return results
+
     @staticmethod
     def _make_ngrams(words, min_size=3, prefix_only=False):
         ngrams = []
@@ -265,158 +1001,342 @@ class ReferentialService(object):
             ngrams.extend(clean_word[i: i+size] for size in size_range for i in range(0, max(0, length - size) + 1))
         return ' '.join(ngrams)
 
+    def _search_format(self):
+        return self.config.get('SEARCH_FORMAT', 'text')
+
+    def _search_fields(self, common_name, search_format):
+        if search_format == 'hashed':
+            return {'trigrams': hashed_trigrams(common_name)}, {'ngrams': '', 'prefix_ngrams': ''}
+        return {
+            'ngrams': self._make_ngrams(common_name),
+            'prefix_ngrams': self._make_ngrams(common_name, prefix_only=True)
+        }, {'trigrams': ''}
+
+    def _search_update(self, entry, now):
+        fields, obsolete = self._search_fields(entry['common_name'], self._search_format())
+        fields.update({
+            'id': entry['id'],
+            'common_name': entry['common_name'],
+            'type': entry['type'],
+            'provider': entry['provider'],
+            'updated_at': now
+        })
+        if self._acl_mode() == 'denormalized':
+            fields['allowed_users'] = entry.get('allowed_users', [])
+        return UpdateOne({'id': entry['id']}, {'$set': fields, '$unset': obsolete}, upsert=True)
+
     @rpc
-    def update_ngrams_search_collection(self):
-        self.database.search.create_index([
-            ('ngrams', TEXT), ('prefix_ngrams', TEXT)
-        ], weights={'ngrams': 100, 'prefix_ngrams': 200})
-
-        entities = self.database.entities.find({},{
-            'id': 1,
-            'common_name': 1,
-            'type': 1,
-            'provider': 1,
-            'allowed_users': 1,
-            '_id': 0})
-        events = self.database.events.find({},{
-            'id': 1,
-            'common_name': 1,
-            'type': 1,
-            'provider': 1,
-            'allowed_users': 1,
-            '_id': 0})
-        for ref_entry in itertools.chain(entities, events):
-            ngrams = self._make_ngrams(ref_entry['common_name'])
-            pref_ngrams = self._make_ngrams(ref_entry['common_name'], prefix_only=True)
-
-            self.database.search.update_one({'id': ref_entry['id']}, {
-                '$set':{
-                    'id': ref_entry['id'],
-                    'common_name': ref_entry['common_name'],
-                    'ngrams': ngrams,
-                    'prefix_ngrams': pref_ngrams,
-                    'type': ref_entry['type'],
-                    'provider': ref_entry['provider'],
-                    'allowed_users': ref_entry['allowed_users']
-                }
-            }, upsert=True)
-        return True
+    def migrate_search_documents(self, search_format='hashed', batch_size=1000):
+        if search_format not in ('text', 'hashed'):
+            raise ReferentialServiceError('Unknown search format {}'.format(search_format))
+
+        query = {'trigrams': {'$exists': False}} if search_format == 'hashed' else {'ngrams': {'$exists': False}}
+        cursor = self._read('search').find(query, {'common_name': 1})
+        migrated = 0
+        batch = []
+        for doc in cursor:
+            fields, obsolete = self._search_fields(doc['common_name'], search_format)
+            batch.append(UpdateOne({'_id': doc['_id']}, {'$set': fields, '$unset': obsolete}))
+            if len(batch) >= batch_size:
+                self.database.search.bulk_write(batch, ordered=False)
+                migrated += len(batch)
+                batch = []
+        if batch:
+            self.database.search.bulk_write(batch, ordered=False)
+            migrated += len(batch)
+        _log.info(f'{migrated} search documents migrated to {search_format} format')
+        return migrated
+
+    @rpc
+    def compare_search_formats(self, queries=None, sample_size=1000):
+        sample = list(self._read('search').aggregate([
+            {'$sample': {'size': sample_size}}, {'$project': {'common_name': 1}}]))
+        if not sample:
+            return None
+
+        text_sizes = 0
+        hashed_sizes = 0
+        text_terms = []
+        hashed_terms = []
+        for doc in sample:
+            fields, _ = self._search_fields(doc['common_name'], 'text')
+            text_sizes += len(bson.BSON.encode(fields))
+            text_terms.append(set(fields['ngrams'].split(' ')))
+            fields, _ = self._search_fields(doc['common_name'], 'hashed')
+            hashed_sizes += len(bson.BSON.encode(fields))
+            hashed_terms.append(set(fields['trigrams']))
+
+        if queries is None:
+            queries = [doc['common_name'].split(' ')[0][0:4] for doc in sample[0:100]]
+
+        recall = 0.
+        precision = 0.
+        for query in queries:
+            text_query = set(self._make_ngrams(query).split(' '))
+            hashed_query = set(query_trigrams(query))
+            expected = set(i for i, terms in enumerate(text_terms) if terms & text_query)
+            found = set(i for i, terms in enumerate(hashed_terms) if terms & hashed_query)
+            recall += len(expected & found) / len(expected) if expected else 1.
+            precision += len(expected & found) / len(found) if found else 1.
+
+        return {
+            'documents': len(sample),
+            'text_bytes_per_document': text_sizes / len(sample),
+            'hashed_bytes_per_document': hashed_sizes / len(sample),
+            'queries': len(queries),
+            'recall': recall / len(queries) if queries else None,
+            'precision': precision / len(queries) if queries else None
+        }
+
+    @rpc
+    def update_ngrams_search_collection(self, incremental=False, batch_size=1000):
+        start = time.monotonic()
+        checkpoint = self._read('referential_meta').find_one({'_id': 'ngrams'}) or {}
+        run = checkpoint.get('run')
+        if run is None or (run['since'] is not None and not incremental):
+            run = {
+                'started_at': datetime.datetime.utcnow(),
+                'since': checkpoint.get('since') if incremental else None,
+                'collection': 'entities',
+                'last_id': None,
+                'processed': 0
+            }
+        else:
+            _log.info(f'Resuming ngrams update started at {run["started_at"]} ...')
+        processed = 0
+
+        def flush(collection, batch):
+            nonlocal processed
+            now = datetime.datetime.utcnow()
+            self.database.search.bulk_write([self._search_update(e, now) for e in batch], ordered=False)
+            processed += len(batch)
+            run.update({'collection': collection, 'last_id': batch[-1]['_id'], 'processed': run['processed'] + len(batch)})
+            self.database.referential_meta.update_one({'_id': 'ngrams'}, {'$set': {'run': run}}, upsert=True)
+            elapsed = time.monotonic() - start
+            _log.info(f'{run["processed"]} search entries updated ({processed / elapsed:.0f} entries/s) ...')
+
+        project = {'id': 1, 'common_name': 1, 'type': 1, 'provider': 1, 'allowed_users': 1}
+        for collection in ('entities', 'events'):
+            if collection == 'entities' and run['collection'] == 'events':
+                continue
+            if run['since'] is not None:
+                # updated_at is stamped by the writer before its write commits and the checkpoint is this service's
+                # start time, so look back far enough to cover slow writes and clock skew between containers
+                since = run['since'] - datetime.timedelta(seconds=self.config.get('SEARCH_INCREMENTAL_MARGIN', 300))
+                cursor = self._read(collection).find({'updated_at': {'$gte': since}}, project)
+            else:
+                query = {}
+                if run['collection'] == collection and run['last_id'] is not None:
+                    query['_id'] = {'$gt': run['last_id']}
+                cursor = self._read(collection).find(query, project).sort('_id', ASCENDING)
+
+            batch = []
+            for entry in cursor:
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    flush(collection, batch)
+                    batch = []
+            if batch:
+                flush(collection, batch)
+            run.update({'collection': 'events', 'last_id': None})
+
+        self.database.referential_meta.update_one({'_id': 'ngrams'}, {
+            '$set': {'since': run['started_at']}, '$unset': {'run': ''}}, upsert=True)
+
+        elapsed = time.monotonic() - start
+        return {
+            'incremental': run['since'] is not None,
+            'processed': run['processed'],
+            'elapsed': elapsed,
+            'throughput': processed / elapsed if elapsed else 0.
+        }
 
     @rpc
     def update_entry_ngrams(self, entry_id):
-        self.database.search.create_index([
-            ('ngrams', TEXT), ('prefix_ngrams', TEXT)
-        ], weights={'ngrams': 100, 'prefix_ngrams': 200})
         project = {'id': 1,'common_name': 1,'type': 1,'provider': 1, 'allowed_users': 1,'_id': 0}
-        entry = self.database.entities.find_one({'id': entry_id}, project)
+        entry = self._read('entities').find_one({'id': entry_id}, project)
         if not entry:
-            entry = self.database.events.find_one({'id': entry_id}, project)
+            entry = self._read('events').find_one({'id': entry_id}, project)
             if not entry:
                 raise ReferentialServiceError('No entry with {} found in referential'.format(entry_id))
-        ngrams = self._make_ngrams(entry['common_name'])
-        pref_ngrams = self._make_ngrams(entry['common_name'], prefix_only=True)
-
-        self.database.search.update_one({'id': entry['id']}, {
-            '$set':{
-                    'id': entry['id'],
-                    'common_name': entry['common_name'],
-                    'ngrams': ngrams,
-                    'prefix_ngrams': pref_ngrams,
-                    'type': entry['type'],
-                    'provider': entry['provider'],
-                    'allowed_users': entry['allowed_users']
-                }
-        }, upsert=True)
+
+        self.database.search.bulk_write([self._search_update(entry, datetime.datetime.utcnow())])
         return entry_id
 
     @rpc
-    def get_event_by_id(self, id, user):
-        event = self.database.events.find_one({'id': id, 'allowed_users': user}, 
-            {'_id': 0, 'allowed_users': 0})
-        return bson.json_util.dumps(event)
+    def get_event_by_id(self, id, user, encoding=None, view=None):
+        return self._cached_find_one('event', 'events', id, user, encoding, view)
 
     @rpc
-    def get_events_by_entity_id(self, entity_id, user, limit=-1):
+    def get_events_by_entity_id(self, entity_id, user, limit=-1, page_size=None, page_token=None, encoding=None,
+            view=None):
+        query = dict({'entities.id': entity_id}, **self._acl_filter(user))
+        projection = self._projection('events', view)
+        if page_size is not None:
+            return self._paginate('events', query,
+                projection, [('date', DESCENDING), ('id', DESCENDING)], page_size, page_token, encoding)
         if limit < 0:
-            cursor = self.database.events.find({'entities.id': entity_id, 'allowed_users': user}, 
-                {'_id': 0, 'allowed_users': 0}).sort('date', -1)
+            cursor = self._read('events').find(query, projection).sort('date', -1)
         else:
-            cursor = self.database.events.find({'entities.id': entity_id, 'allowed_users': user}, 
-                {'_id': 0, 'allowed_users': 0}).sort('date', -1).limit(limit)
-        return bson.json_util.dumps(list(cursor))
+            cursor = self._read('events').find(query, projection).sort('date', -1).limit(limit)
+        return self._encode(list(cursor), encoding)
 
     @rpc
-    def get_event_filtered_by_entities(self, id, entity_ids, user):
-        event = self.database.events.find_one({
+    def get_event_filtered_by_entities(self, id, entity_ids, user, encoding=None, view=None):
+        event = self._read('events').find_one(dict({
             'id': id,
-            'allowed_users': user,
             'entities.id': {'$all': entity_ids}
-        }, {'_id': 0, 'allowed_users': 0})
+        }, **self._acl_filter(user)), self._projection('events', view))
 
-        return bson.json_util.dumps(event)
+        return self._encode(event, encoding)
 
     @rpc
-    def get_events_by_name(self, name, user):
-        cursor = self.database.events.find({'$text': {'$search': name}, 'allowed_users': user}, 
-            {'_id': 0, 'allowed_users': 0})
-        return bson.json_util.dumps(list(cursor))
+    def get_events_by_name(self, name, user, page_size=None, page_token=None, encoding=None, view=None):
+        query = dict({'$text': {'$search': name}}, **self._acl_filter(user))
+        projection = self._projection('events', view)
+        if page_size is not None:
+            return self._paginate('events', query, projection,
+                [('date', DESCENDING), ('id', DESCENDING)], page_size, page_token, encoding)
+        cursor = self._read('events').find(query, projection)
+        return self._encode(list(cursor), encoding)
 
     @rpc
-    def get_events_between_dates(self, start_date, end_date, user):
+    def get_events_between_dates(self, start_date, end_date, user, page_size=None, page_token=None,
+            encoding=None, view=None):
         _log.info(f'{user} is searching for allowed events between {start_date} and {end_date} ...')
-        cursor = self.database.events.find({'date': {'$gte': dateutil.parser.parse(start_date),'$lt': dateutil.parser.parse(end_date)},
-            'allowed_users': user}, {'_id': 0})
+        query = dict({'date': {'$gte': dateutil.parser.parse(start_date),'$lt': dateutil.parser.parse(end_date)}},
+            **self._acl_filter(user))
+        projection = self._projection('events', view, full={'_id': 0})
+        if page_size is not None:
+            return self._paginate('events', query, projection,
+                [('date', ASCENDING), ('id', ASCENDING)], page_size, page_token, encoding)
+        cursor = self._read('events').find(query, projection)
         result = list(cursor)
         if len(result) == 0:
             _log.warning('No result found!')
-        return bson.json_util.dumps(result)
+        return self._encode(result, encoding)
+
+    def _next_labels_version(self, count=1):
+        return self.database.counters.find_one_and_update({'_id': 'labels'}, {'$inc': {'version': count}},
+            upsert=True, return_document=ReturnDocument.AFTER)['version']
+
+    @staticmethod
+    def _parse_labels(items, fields):
+        parsed = []
+        errors = []
+        for i, item in enumerate(items):
+            try:
+                if isinstance(item, dict):
+                    values = [item[f] for f in fields]
+                elif isinstance(item, (list, tuple)):
+                    values = list(item)[:len(fields)]
+                else:
+                    raise TypeError('expected a dict, list or tuple')
+                if len(values) != len(fields):
+                    raise ValueError('expected {}'.format(', '.join(fields)))
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append({'index': i, 'error': '{}: {}'.format(type(e).__name__, e)})
+                continue
+            parsed.append((i, dict(zip(fields, values))))
+        return parsed, errors
+
+    def _bulk_write_labels(self, collection, chunk, operations, errors):
+        try:
+            return self.database[collection].bulk_write(operations, ordered=False).bulk_api_result
+        except BulkWriteError as bwe:
+            for error in bwe.details['writeErrors']:
+                errors.append({'index': chunk[error['index']][0], 'error': error['errmsg']})
+            return bwe.details
+
+    def _get_labels(self):
+        self.labels.refresh(self._read_database())
+        return self.labels
 
     @rpc
     def add_label(self, id, language, context, label):
-        self.database.labels.create_index([('id', ASCENDING),
-                                           ('language', ASCENDING), ('context', ASCENDING)], unique=True)
-
         self.database.labels.update_one({'id': id, 'language': language, 'context': context},
-                                        {'$set': {'label': label}}, upsert=True)
+                                        {'$set': {'label': label, 'version': self._next_labels_version()}},
+                                        upsert=True)
+        self._record_changes([self._change('label', id, 'upsert', ['{}/{}'.format(language, context)])])
 
         return {'id': id, 'language': language, 'context': context}
 
     @rpc
     def delete_label(self, id, language, context):
-        self.database.labels.delete_one({'id': id, 'language': language, 'context': context})
+        key = {'id': id, 'language': language, 'context': context}
+        if self.database.labels.delete_one(key).deleted_count:
+            self.database.label_tombstones.update_one(key,
+                {'$set': {'version': self._next_labels_version()}}, upsert=True)
+            self._record_changes([self._change('label', id, 'delete', ['{}/{}'.format(language, context)])])
 
         return {'id': id, 'language': language, 'context': context}
 
+    @rpc
+    def add_labels(self, labels, chunk_size=1000):
+        parsed, errors = self._parse_labels(labels, ('id', 'language', 'context', 'label'))
+        upserted = 0
+        modified = 0
+        for start in range(0, len(parsed), chunk_size):
+            chunk = parsed[start:start + chunk_size]
+            first = self._next_labels_version(len(chunk)) - len(chunk) + 1
+            result = self._bulk_write_labels('labels', chunk, [
+                UpdateOne({'id': l['id'], 'language': l['language'], 'context': l['context']},
+                          {'$set': {'label': l['label'], 'version': first + j}}, upsert=True)
+                for j, (_, l) in enumerate(chunk)], errors)
+            upserted += result['nUpserted']
+            modified += result['nModified']
+            failed = set(e['index'] for e in errors)
+            self._record_changes([self._change('label', l['id'], 'upsert', ['{language}/{context}'.format(**l)])
+                                  for i, l in chunk if i not in failed])
+        _log.info(f'{upserted} labels inserted and {modified} updated ({len(errors)} errors)')
+        return {'upserted': upserted, 'modified': modified, 'errors': sorted(errors, key=lambda e: e['index'])}
+
+    @rpc
+    def delete_labels(self, labels, chunk_size=1000):
+        parsed, errors = self._parse_labels(labels, ('id', 'language', 'context'))
+        deleted = 0
+        for start in range(0, len(parsed), chunk_size):
+            chunk = parsed[start:start + chunk_size]
+            result = self._bulk_write_labels('labels', chunk, [DeleteOne(l) for _, l in chunk], errors)
+            deleted += result['nRemoved']
+            failed = set(e['index'] for e in errors)
+            self._record_changes([self._change('label', l['id'], 'delete', ['{language}/{context}'.format(**l)])
+                                  for i, l in chunk if i not in failed])
+            first = self._next_labels_version(len(chunk)) - len(chunk) + 1
+            self._bulk_write_labels('label_tombstones', chunk, [
+                UpdateOne(l, {'$set': {'version': first + j}}, upsert=True)
+                for j, (_, l) in enumerate(chunk)], errors)
+        _log.info(f'{deleted} labels deleted ({len(errors)} errors)')
+        return {'deleted': deleted, 'errors': sorted(errors, key=lambda e: e['index'])}
+
     @rpc
     def get_labels_by_id_and_language_and_context(self, ids, language, context):
         if type(ids) == list:
-            cursor = self.database.labels.find({
-                'id': {'$in': ids},
-                'language': language, 'context': context}, {'_id': 0})
-            return list(cursor)
+            return self._get_labels().get_many(ids, language, context)
 
-        return self.database.labels.find_one({'id': ids, 'language': language, 'context': context}, {'_id': 0})
+        return self._get_labels().get(ids, language, context)
 
     @rpc
     def get_labels_by_id(self, ids):
         if type(ids) == list:
-            cursor = self.database.labels.find({'id': {'$in': ids}}, {'_id': 0})
-            return list(cursor)
+            return self._get_labels().get_by_id(ids)
+
+        return self._get_labels().get_by_id([ids])
 
-        return list(self.database.labels.find({'id': ids}, {'_id': 0}))
+    @rpc
+    def get_labels_stats(self):
+        return self._get_labels().stats()
 
     @rpc
-    def search_entity(self, name, user, type=None, provider=None):
-        query = {'$text': {'$search': name}, 'allowed_users': user}
+    def search_entity(self, name, user, type=None, provider=None, encoding=None, view=None):
+        query = dict({'$text': {'$search': name}}, **self._acl_filter(user, provider))
         if type is not None:
             query['type'] = type
-        if provider is not None:
-            query['provider'] = provider
-        cursor = self.database.entities.find(query, {'_id': 0, 'allowed_users': 0})
-        return bson.json_util.dumps(list(cursor))
+        cursor = self._read('entities').find(query, self._projection('entities', view))
+        return self._encode(list(cursor), encoding)
 
     @rpc
-    def search_event(self, name, date, user, type=None, provider=None):
+    def search_event(self, name, date, user, type=None, provider=None, encoding=None, view=None):
         start_date = dateutil.parser.parse(date)
         end_date = start_date + datetime.timedelta(days=1)
 
@@ -427,38 +1347,65 @@ class ReferentialService(object):
             },
             '$text': {
                 '$search': name
-            },
-            'allowed_users': user
+            }
         }
+        query.update(self._acl_filter(user, provider))
 
         if type is not None:
             query['type'] = type
-        if provider is not None:
-            query['provider'] = provider
 
-        cursor = self.database.events.find(query, {'_id': 0, 'allowed_users': 0})
-        return bson.json_util.dumps(list(cursor))
+        cursor = self._read('events').find(query, self._projection('events', view))
+        return self._encode(list(cursor), encoding)
 
     @rpc
-    def fuzzy_search(self, query, user, type=None, provider=None, limit=-1):
+    def fuzzy_search(self, query, user, type=None, provider=None, limit=-1, encoding=None):
+        if self.search_index.enabled:
+            self.search_index.refresh(self._read('search'))
+            providers = self._get_user_providers(user) if self._acl_mode() == 'provider' else None
+            return self._encode(self.search_index.search(query, user, type, provider, limit, providers), encoding)
+
+        if self._search_format() == 'hashed':
+            return self._hashed_fuzzy_search(query, user, type, provider, limit, encoding)
+
         query = {
-            '$text': {'$search': self._make_ngrams(query)},
-            'allowed_users': user
+            '$text': {'$search': self._make_ngrams(query)}
         }
+        query.update(self._acl_filter(user, provider))
 
         if type is not None:
             query['type'] = type
-        if provider is not None:
-            query['provider'] = provider
 
         if limit < 0:
-            cursor = self.database.search.find(
+            cursor = self._read('search').find(
                 query,
                 {'id': 1, 'common_name': 1, 'score': {'$meta': 'textScore'}, '_id': 0}
                 ).sort([('score', {'$meta': 'textScore'})])
         else:
-            cursor = self.database.search.find(
+            cursor = self._read('search').find(
                 query,
                 {'id': 1, 'common_name': 1, 'score': {'$meta': 'textScore'}, '_id': 0}
                 ).sort([('score', {'$meta': 'textScore'})]).limit(limit)
-        return bson.json_util.dumps(list(cursor))
+        return self._encode(list(cursor), encoding)
+
+    def _hashed_fuzzy_search(self, query, user, type, provider, limit, encoding):
+        grams = query_trigrams(query)
+        match = dict({'trigrams': {'$in': grams}}, **self._acl_filter(user, provider))
+        if type is not None:
+            match['type'] = type
+
+        pipeline = [
+            {'$match': match},
+            {'$project': {
+                'id': 1,
+                'common_name': 1,
+                'score': {'$add': [
+                    {'$multiply': [100, {'$size': {'$setIntersection': ['$trigrams', grams]}}]},
+                    {'$multiply': [200, {'$size': {'$setIntersection': ['$trigrams', [g | PREFIX_FLAG for g in grams]]}}]}
+                ]},
+                '_id': 0
+            }},
+            {'$sort': {'score': -1}}
+        ]
+        if limit > 0:
+            pipeline.append({'$limit': limit})
+        return self._encode(list(self._read('search').aggregate(pipeline)), encoding)
@@ -0,0 +1,238 @@
+import argparse
+import datetime
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient
+
+from application.indexes import ensure_indexes
+
+
+_log = logging.getLogger(__name__)
+
+MAGIC = b'REFSNAP1'
+
+MANIFEST = '__manifest__'
+
+COLLECTIONS = ('entities', 'events', 'labels', 'label_tombstones', 'subscriptions', 'search', 'pictures', 'fs.files',
+               'fs.chunks', 'changes', 'counters')
+
+# Counters are merged with $max rather than restored so that versions handed out after the snapshot are never reused
+MERGED = ('counters',)
+
+STAGING_PREFIX = 'snapshot_import.'
+
+_FRAME_HEADER = struct.Struct('>HIII')
+
+_RAW = CodecOptions(document_class=RawBSONDocument)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _write_frame(stream, name, docs, level):
+    data = b''.join(docs)
+    compressed = zlib.compress(data, level)
+    name = name.encode('utf-8')
+    stream.write(_FRAME_HEADER.pack(len(name), len(docs), len(compressed), zlib.crc32(data)))
+    stream.write(name)
+    stream.write(compressed)
+    return len(compressed)
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise SnapshotError('Truncated snapshot')
+    return data
+
+
+def _split(data):
+    docs = []
+    position = 0
+    while position < len(data):
+        size = struct.unpack_from('<i', data, position)[0]
+        if size < 5 or position + size > len(data):
+            raise SnapshotError('Corrupted document in snapshot frame')
+        docs.append(RawBSONDocument(data[position:position + size]))
+        position += size
+    return docs
+
+
+def read_frames(stream):
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise SnapshotError('Not a referential snapshot')
+    while True:
+        header = stream.read(_FRAME_HEADER.size)
+        if not header:
+            raise SnapshotError('Snapshot has no manifest')
+        if len(header) != _FRAME_HEADER.size:
+            raise SnapshotError('Truncated snapshot')
+        name_size, count, size, checksum = _FRAME_HEADER.unpack(header)
+        name = _read_exactly(stream, name_size).decode('utf-8')
+        try:
+            data = zlib.decompress(_read_exactly(stream, size))
+        except zlib.error as e:
+            raise SnapshotError('Corrupted {} frame: {}'.format(name, e))
+        if zlib.crc32(data) != checksum:
+            raise SnapshotError('Checksum mismatch in {} frame'.format(name))
+        docs = _split(data)
+        if len(docs) != count:
+            raise SnapshotError('Document count mismatch in {} frame'.format(name))
+        yield name, docs
+        if name == MANIFEST:
+            return
+
+
+def export_snapshot(database, stream, collections=COLLECTIONS, chunk_bytes=4 * 1024 * 1024, level=6):
+    start = time.monotonic()
+    stream.write(MAGIC)
+    counts = {}
+    written = 0
+    for name in collections:
+        counts[name] = 0
+        docs = []
+        size = 0
+        for doc in database.get_collection(name, codec_options=_RAW).find().batch_size(1000):
+            docs.append(doc.raw)
+            size += len(doc.raw)
+            if size >= chunk_bytes:
+                written += _write_frame(stream, name, docs, level)
+                counts[name] += len(docs)
+                docs = []
+                size = 0
+        if docs:
+            written += _write_frame(stream, name, docs, level)
+            counts[name] += len(docs)
+        _log.info(f'{counts[name]} {name} documents exported')
+
+    manifest = {'format': 1, 'created_at': datetime.datetime.utcnow(), 'collections': counts}
+    written += _write_frame(stream, MANIFEST, [bson.BSON.encode(manifest)], level)
+    return {'collections': counts, 'bytes': written, 'elapsed': time.monotonic() - start}
+
+
+def _staging(name, drop):
+    return STAGING_PREFIX + name if drop or name in MERGED else name
+
+
+def _drop_staging(database):
+    for name in database.list_collection_names():
+        if name.startswith(STAGING_PREFIX):
+            database.drop_collection(name)
+
+
+def _merge_counters(database, name):
+    for doc in database[STAGING_PREFIX + name].find():
+        fields = dict((k, v) for k, v in doc.items() if k != '_id')
+        if fields:
+            database[name].update_one({'_id': doc['_id']}, {'$max': fields}, upsert=True)
+
+
+def import_snapshot(database, stream, drop=True, workers=4, build_indexes=True):
+    start = time.monotonic()
+    batches = queue.Queue(maxsize=workers * 2)
+    errors = []
+    counts = {}
+    _drop_staging(database)
+
+    def insert():
+        while True:
+            batch = batches.get()
+            try:
+                if batch is None:
+                    return
+                if not errors:
+                    database[_staging(batch[0], drop)].insert_many(batch[1], ordered=False,
+                                                                   bypass_document_validation=True)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                batches.task_done()
+
+    threads = [threading.Thread(target=insert, name='snapshot-import-{}'.format(i)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    # With drop, frames are loaded into staging collections that only replace the live ones once the whole
+    # stream has been verified, so a corrupted snapshot leaves the database untouched.
+    manifest = None
+    try:
+        try:
+            for name, docs in read_frames(stream):
+                if errors:
+                    break
+                if name == MANIFEST:
+                    manifest = docs[0]
+                    break
+                counts[name] = counts.get(name, 0) + len(docs)
+                batches.put((name, docs))
+        finally:
+            for _ in threads:
+                batches.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise SnapshotError('Snapshot import failed: {}'.format(errors[0]))
+        if manifest is None:
+            raise SnapshotError('Snapshot has no manifest')
+        expected = dict(manifest['collections'])
+        if any(counts.get(name, 0) != count for name, count in expected.items()):
+            raise SnapshotError('Snapshot content does not match its manifest: {} != {}'.format(counts, expected))
+
+        for name in expected:
+            if name in MERGED:
+                _merge_counters(database, name)
+            elif drop and counts.get(name):
+                database[STAGING_PREFIX + name].rename(name, dropTarget=True)
+            elif drop:
+                database.drop_collection(name)
+    finally:
+        _drop_staging(database)
+
+    if build_indexes:
+        ensure_indexes(database, force=True)
+    return {'collections': counts, 'elapsed': time.monotonic() - start}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export or import a referential snapshot')
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('path', help='Snapshot file, - for stdout/stdin')
+    parser.add_argument('--uri', default=os.environ.get('MONGODB_CONNECTION_URL', 'mongodb://localhost:27017'))
+    parser.add_argument('--db', default=os.environ.get('MONGODB_DB_NAME', 'referential'))
+    parser.add_argument('--collections', nargs='*', default=list(COLLECTIONS))
+    parser.add_argument('--chunk-bytes', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--no-drop', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    client = MongoClient(args.uri)
+    try:
+        database = client[args.db]
+        if args.command == 'export':
+            stream = sys.stdout.buffer if args.path == '-' else open(args.path, 'wb')
+            with stream:
+                result = export_snapshot(database, stream, args.collections, args.chunk_bytes, args.level)
+        else:
+            stream = sys.stdin.buffer if args.path == '-' else open(args.path, 'rb')
+            with stream:
+                result = import_snapshot(database, stream, not args.no_drop, args.workers)
+    finally:
+        client.close()
+    _log.info(f'Snapshot {args.command} done: {result}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,33 @@
 import pytest
 import datetime
+import json
 import hashlib
 import binascii
 import tempfile
 import base64
+import io
+from unittest.mock import Mock
 from pymongo import MongoClient, TEXT, ASCENDING
+from pymongo.errors import ExecutionTimeout
 from nameko.testing.services import worker_factory
 import bson.json_util
+from bson.objectid import ObjectId
 import gridfs
 
 from application.services.referential import ReferentialService, ReferentialServiceError
+from application.indexes import ensure_indexes, INDEXES_VERSION
+from application.encoders import get_encoder
+from application.snapshot import export_snapshot, import_snapshot, SnapshotError
+from application.dependencies.allowed_users import ProviderUsersCache
+from application.dependencies.search_index import InMemorySearch
+from application.dependencies.cache import LRUCache
+from application.dependencies.jobs import BackgroundJobs
+from application.dependencies.labels import LabelDictionary
+from application.dependencies.metrics import MetricsRegistry, WorkerCall
+from application.dependencies.slow_queries import query_shape, plan_summary, redact_plan
+from application.dependencies.write_buffer import EntityWriteBuffer
+from application.dependencies.outbox import Outbox
+from application.dependencies.routing import Route, Routing, BudgetedCollection, read_preference
 
 
 @pytest.fixture
@@ -22,8 +40,140 @@ def database(db_url):
     client.close()
 
 
-def test_add_entity(database):
-    service = worker_factory(ReferentialService, database=database)
+@pytest.fixture
+def service(database):
+    return worker_factory(ReferentialService, database=database, config={},
+                          allowed_users_cache=ProviderUsersCache(), search_index=InMemorySearch(),
+                          response_cache=LRUCache(), picture_cache=LRUCache(1024 * 1024, weigh=lambda v: len(v[1])),
+                          jobs=BackgroundJobs(), labels=LabelDictionary(refresh_interval=0),
+                          entity_writes=EntityWriteBuffer(), outbox=Outbox(batch_size=2), routing=Route())
+
+
+def test_ensure_indexes(database, service):
+    report = service.check_indexes()
+    assert 'id_1_allowed_users_1' in report['entities']['missing']
+
+    assert ensure_indexes(database)
+    assert not ensure_indexes(database)
+    assert database.referential_meta.find_one({'_id': 'indexes'})['version'] == INDEXES_VERSION
+
+    report = service.check_indexes()
+    for collection in ('entities', 'events', 'search', 'labels', 'subscriptions', 'fs.files', 'fs.chunks'):
+        assert not report[collection]['missing']
+        assert not report[collection]['changed']
+
+    database.labels.drop_index('id_1_language_1_context_1')
+    database.labels.create_index([('id', ASCENDING), ('language', ASCENDING), ('context', ASCENDING)])
+    database.labels.create_index('label')
+    report = service.check_indexes()
+    assert report['labels']['changed'] == ['id_1_language_1_context_1']
+    assert report['labels']['extra'] == ['label_1']
+
+    assert ensure_indexes(database, force=True)
+    assert database.labels.index_information()['id_1_language_1_context_1']['unique']
+
+
+def test_metrics(database):
+    registry = MetricsRegistry(max_workers=10)
+    service = worker_factory(ReferentialService, database=database, metrics=registry, routing=Route())
+
+    call = WorkerCall(registry, ('rpc', 'get_entity_by_id'))
+    assert registry.snapshot()['inflight'] == 1
+    call.command('find', 0.002)
+    call.command('find', 0.003)
+    call.finish()
+    call = WorkerCall(registry, ('rpc', 'get_entity_by_id'))
+    call.error = True
+    call.finish()
+
+    metrics = service.get_metrics()
+    entrypoint = metrics['entrypoints']['rpc.get_entity_by_id']
+    assert metrics['inflight'] == 0
+    assert entrypoint['calls'] == 2
+    assert entrypoint['errors'] == 1
+    assert entrypoint['mongo_commands'] == {'find': 2}
+    assert entrypoint['latency']['count'] == 2
+
+    status, headers, body = service.export_metrics(None)
+    assert status == 200
+    assert 'referential_max_workers 10' in body
+    assert 'referential_calls_total{type="rpc",entrypoint="get_entity_by_id"} 2' in body
+    assert 'referential_mongo_commands_total{type="rpc",entrypoint="get_entity_by_id",command="find"} 2' in body
+    assert 'referential_latency_seconds_bucket{type="rpc",entrypoint="get_entity_by_id",le="+Inf"} 2' in body
+
+
+def test_slow_queries(database, service):
+    shape = json.loads(query_shape('find', {'find': 'events', 'filter': {'entities.id': 'en0', 'allowed_users': 'admin'},
+                                            'sort': {'date': -1}}))
+    assert shape == {'filter': {'entities.id': '<str>', 'allowed_users': '<str>'}, 'sort': {'date': -1}}
+    assert query_shape('find', {'filter': {'id': {'$in': ['0', '1']}}}) == \
+        query_shape('find', {'filter': {'id': {'$in': ['2']}}})
+    assert plan_summary({'stage': 'SORT', 'inputStage': {'stage': 'FETCH', 'inputStage': {
+        'stage': 'IXSCAN', 'indexName': 'entities.id_1'}}}) == 'SORT > FETCH > IXSCAN(entities.id_1)'
+    assert redact_plan({'stage': 'FETCH', 'filter': {'allowed_users': {'$eq': 'admin'}}, 'inputStage': {
+        'stage': 'IXSCAN', 'indexName': 'entities.id_1', 'indexBounds': {'entities.id': ['["en0", "en0"]']}}}) == {
+        'stage': 'FETCH', 'filter': {'allowed_users': {'$eq': '<str>'}}, 'inputStage': {
+            'stage': 'IXSCAN', 'indexName': 'entities.id_1', 'indexBounds': {'entities.id': ['<str>']}}}
+
+    now = datetime.datetime.utcnow()
+    database.slow_queries.insert_many([
+        {'at': now, 'entrypoint': 'get_events_by_entity_id', 'command': 'find', 'collection': 'events',
+         'shape': 'a', 'duration_ms': 150., 'docs_returned': 10, 'docs_examined': 20000, 'plan_summary': 'COLLSCAN'},
+        {'at': now, 'entrypoint': 'get_events_by_entity_id', 'command': 'find', 'collection': 'events',
+         'shape': 'a', 'duration_ms': 250., 'docs_returned': 10, 'docs_examined': None, 'plan_summary': None},
+        {'at': now, 'entrypoint': 'get_entity_by_id', 'command': 'find', 'collection': 'entities',
+         'shape': 'b', 'duration_ms': 300., 'docs_returned': 1, 'docs_examined': 1, 'plan_summary': 'IXSCAN'}
+    ])
+    top = bson.json_util.loads(service.get_slow_queries())
+    assert [q['entrypoint'] for q in top] == ['get_events_by_entity_id', 'get_entity_by_id']
+    assert top[0]['count'] == 2
+    assert top[0]['total_ms'] == 400.
+    assert top[0]['docs_examined'] == 20000
+    assert top[0]['plan_summary'] == 'COLLSCAN'
+    assert len(bson.json_util.loads(service.get_slow_queries(limit=1))) == 1
+
+
+def test_snapshot(database, service):
+    database.subscriptions.insert_one({'user': 'admin', 'subscription': {'providers': ['me'], 'pictures': ['ctx']}})
+    for i in range(50):
+        service.add_entity(str(i), 'Entity {}'.format(i), 'me', 'player')
+    service.add_label('0', 'fr', 'ctx', 'Nom')
+    service.add_picture_to_entity('0', 'ctx', 'png', base64.b64encode(b'picture').decode('utf-8'))
+
+    stream = io.BytesIO()
+    result = export_snapshot(database, stream, chunk_bytes=1024)
+    assert result['collections']['entities'] == 50
+    assert result['collections']['fs.chunks'] == 1
+
+    database.entities.delete_many({'id': {'$in': ['0', '1']}})
+    database.labels.insert_one({'id': 'stale', 'language': 'fr', 'context': 'ctx', 'label': 'Stale'})
+    service.add_entity('50', 'Entity 50', 'me', 'player')
+    latest = database.counters.find_one({'_id': 'changes'})['version']
+    stream.seek(0)
+    result = import_snapshot(database, stream, workers=2)
+    assert result['collections']['entities'] == 50
+    assert database.entities.count_documents({}) == 50
+    assert database.labels.count_documents({}) == 1
+    assert database.changes.count_documents({}) == result['collections']['changes']
+    assert database.counters.find_one({'_id': 'changes'})['version'] == latest
+    service.add_entity('51', 'Entity 51', 'me', 'player')
+    assert database.changes.find_one({'id': '51'})['version'] == latest + 1
+    assert 'id_1_allowed_users_1' in database.entities.index_information()
+    assert service.get_entity_picture('0', 'ctx', 'png', 'admin') == base64.b64encode(b'picture').decode('utf-8')
+
+    corrupted = bytearray(stream.getvalue())
+    corrupted[-5] ^= 0xff
+    with pytest.raises(SnapshotError):
+        import_snapshot(database, io.BytesIO(bytes(corrupted)))
+    with pytest.raises(SnapshotError):
+        import_snapshot(database, io.BytesIO(stream.getvalue()[:-10]))
+    assert database.entities.count_documents({}) == 51
+    assert database.labels.count_documents({}) == 1
+    assert not [name for name in database.list_collection_names() if name.startswith('snapshot_import.')]
+
+
+def test_add_entity(database, service):
+    ensure_indexes(database)
 
     service.add_entity('0', 'Notorious BIG', 'me', 'mc',
                        {'first_name': 'Christopher', 'last_name': 'Wallace', 'aka': 'Biggie Small'})
@@ -37,8 +187,184 @@ def test_add_entity(database):
     assert len(list(result)) == 2
 
 
-def test_add_informations_to_entity(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_add_entities_bulk(database, service):
+    database.subscriptions.insert_one({'user': 'admin', 'subscription': {'providers': ['me']}})
+
+    res = service.add_entities_bulk([
+        {'id': '0', 'common_name': 'Notorious BIG', 'provider': 'me', 'type': 'mc',
+         'informations': {'first_name': 'Christopher'}},
+        {'id': '1', 'common_name': 'Big L', 'provider': 'other', 'type': 'mc'},
+        {'id': '2', 'provider': 'me', 'type': 'mc'}
+    ])
+    assert [r['status'] for r in res] == ['ok', 'ok', 'error']
+    assert res[2]['id'] == '2'
+
+    res = service.add_entities_bulk([
+        {'common_name': 'No id', 'provider': 'me', 'type': 'mc'},
+        {'id': '3', 'common_name': 'Bad provider', 'provider': ['me'], 'type': 'mc'},
+        {'id': {'$gt': ''}, 'common_name': 'Bad id', 'provider': 'me', 'type': 'mc'},
+        'not a record',
+        {'id': '4', 'common_name': 'Nas', 'provider': 'me', 'type': 'mc'}
+    ])
+    assert [r['status'] for r in res] == ['error', 'error', 'error', 'error', 'ok']
+    assert [r['id'] for r in res] == [None, '3', None, None, '4']
+    assert database.entities.find_one({'id': '4'})['allowed_users'] == ['admin']
+
+    result = database.entities.find_one({'id': '0'})
+    assert result['allowed_users'] == ['admin']
+    assert result['informations']['first_name'] == 'Christopher'
+    assert database.entities.find_one({'id': '1'})['allowed_users'] == []
+    assert not database.entities.find_one({'id': '2'})
+
+
+def test_allowed_users_cache(database, service):
+    database.subscriptions.insert_one({'user': 'admin', 'subscription': {'providers': ['me']}})
+
+    service.add_entity('0', 'Notorious BIG', 'me', 'mc')
+    service.add_entity('1', 'Big L', 'me', 'mc')
+    stats = service.get_allowed_users_cache_stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 1
+
+    service.handle_suscription({'user': 'other', 'subscription': {'referential': {'providers': ['me']}}})
+    assert service.get_allowed_users_cache_stats()['size'] == 0
+
+    service.add_entity('2', 'Biggie', 'me', 'mc')
+    assert sorted(database.entities.find_one({'id': '2'})['allowed_users']) == ['admin', 'other']
+
+
+def test_handle_subscription(database, service):
+    database.entities.insert_many([
+        {'id': '0', 'common_name': 'A', 'provider': 'p1', 'type': 't', 'allowed_users': ['admin']},
+        {'id': '1', 'common_name': 'B', 'provider': 'p2', 'type': 't', 'allowed_users': ['admin']},
+        {'id': '2', 'common_name': 'C', 'provider': 'p3', 'type': 't', 'allowed_users': []}
+    ])
+    database.subscriptions.insert_one({'user': 'admin', 'subscription': {'providers': ['p1', 'p2']}})
+
+    service.handle_suscription({'user': 'admin', 'subscription': {'referential': {'providers': ['p2', 'p3']}}})
+    assert database.entities.find_one({'id': '0'})['allowed_users'] == []
+    assert database.entities.find_one({'id': '1'})['allowed_users'] == ['admin']
+    assert database.entities.find_one({'id': '2'})['allowed_users'] == ['admin']
+    assert database.subscriptions.find_one({'user': 'admin'})['subscription']['providers'] == ['p2', 'p3']
+
+    job = database.jobs.find_one({'user': 'admin'})
+    assert job['status'] == 'done'
+    assert job['added'] == ['p3']
+    assert job['removed'] == ['p1']
+    assert len(job['steps']) == 6
+    assert bson.json_util.loads(service.get_job(job['_id']))['progress'] == 1.
+    service.dispatch.assert_called_with('subscription_applied', {'user': 'admin', 'providers': ['p3', 'p1']})
+
+    service.handle_suscription({'user': 'admin', 'subscription': {'referential': {'providers': ['p2', 'p3']}}})
+    assert database.jobs.count_documents({}) == 1
+
+
+def test_resume_subscription_job(database, service):
+    database.entities.insert_many([
+        {'id': '0', 'common_name': 'A', 'provider': 'p1', 'type': 't', 'allowed_users': []},
+        {'id': '1', 'common_name': 'B', 'provider': 'p1', 'type': 't', 'allowed_users': []}
+    ])
+    database.jobs.insert_one({
+        '_id': 'job', 'type': 'subscription', 'user': 'admin', 'subscription': {'providers': ['p1']},
+        'added': ['p1'], 'removed': [], 'status': 'running', 'progress': 1 / 3.,
+        'steps': [{'collection': 'entities', 'direction': 'add', 'done': True},
+                  {'collection': 'events', 'direction': 'add', 'done': False},
+                  {'collection': 'search', 'direction': 'add', 'done': False}]
+    })
+
+    assert service.resume_jobs() == ['job']
+    assert database.jobs.find_one({'_id': 'job'})['status'] == 'done'
+    assert database.entities.find_one({'id': '0'})['allowed_users'] == []
+    assert database.subscriptions.find_one({'user': 'admin'})['subscription'] == {'providers': ['p1']}
+
+
+def test_failed_subscription_job(database, service):
+    database.entities.insert_one({'id': '0', 'common_name': 'A', 'provider': 'p1', 'type': 't', 'allowed_users': []})
+    add_provider_subscription = service._add_provider_subscription
+
+    def failing(user, providers, collection):
+        if collection == 'events':
+            raise RuntimeError('transient')
+        return add_provider_subscription(user, providers, collection)
+
+    service._add_provider_subscription = failing
+    service.handle_suscription({'user': 'admin', 'subscription': {'referential': {'providers': ['p1']}}})
+    job = database.jobs.find_one({'user': 'admin'})
+    assert job['status'] == 'failed'
+    assert job['error'] == 'transient'
+    assert [s['done'] for s in job['steps']] == [True, False, False]
+    assert not database.subscriptions.find_one({'user': 'admin'})
+
+    service._add_provider_subscription = add_provider_subscription
+    assert service.resume_jobs() == [job['_id']]
+    assert database.jobs.find_one({'_id': job['_id']})['status'] == 'done'
+    assert database.entities.find_one({'id': '0'})['allowed_users'] == ['admin']
+
+    spawned = []
+    jobs = BackgroundJobs(spawn=spawned.append)
+    jobs.submit('admin', failing, 'admin', ['p1'], 'events')
+    spawned[0]()
+
+
+def test_superseded_subscription_job(database, service):
+    database.entities.insert_one({'id': '0', 'common_name': 'A', 'provider': 'p1', 'type': 't', 'allowed_users': []})
+    job = {'_id': 'job', 'type': 'subscription', 'user': 'admin', 'subscription': {'providers': ['p1']},
+           'added': ['p1'], 'removed': [], 'status': 'superseded', 'progress': 0.,
+           'steps': [{'collection': c, 'direction': 'add', 'done': False} for c in ('entities', 'events', 'search')]}
+    database.jobs.insert_one(job)
+    service._run_subscription_job('job')
+    assert database.jobs.find_one({'_id': 'job'})['status'] == 'superseded'
+    assert database.entities.find_one({'id': '0'})['allowed_users'] == []
+
+    # Superseded by another container while its steps run
+    database.jobs.update_one({'_id': 'job'}, {'$set': {'status': 'pending'}})
+    add_provider_subscription = service._add_provider_subscription
+
+    def superseding(user, providers, collection):
+        database.jobs.update_one({'_id': 'job'}, {'$set': {'status': 'superseded'}})
+        return add_provider_subscription(user, providers, collection)
+
+    service._add_provider_subscription = superseding
+    service._run_subscription_job('job')
+    job = database.jobs.find_one({'_id': 'job'})
+    assert job['status'] == 'superseded'
+    assert [s['done'] for s in job['steps']] == [False, False, False]
+    assert not database.subscriptions.find_one({'user': 'admin'})
+    service.dispatch.assert_not_called()
+
+
+def test_provider_acl_mode(database):
+    service = worker_factory(ReferentialService, database=database, config={'ACL_MODE': 'provider'},
+                             allowed_users_cache=ProviderUsersCache(), search_index=InMemorySearch(),
+                             response_cache=LRUCache(), picture_cache=LRUCache(), jobs=BackgroundJobs(),
+                             routing=Route())
+    database.subscriptions.insert_one({'user': 'admin', 'subscription': {'providers': ['p1']}})
+    database.entities.insert_one({'id': '0', 'common_name': 'Alpha', 'provider': 'p1', 'type': 't',
+                                  'allowed_users': ['admin']})
+    database.entities.create_index([('common_name', TEXT)], default_language='english')
+    service.add_entity('1', 'Bravo', 'p2', 't')
+    assert 'allowed_users' not in database.entities.find_one({'id': '1'})
+
+    assert bson.json_util.loads(service.get_entity_by_id('0', 'admin'))['id'] == '0'
+    assert bson.json_util.loads(service.get_entity_by_id('1', 'admin')) is None
+    assert len(bson.json_util.loads(service.search_entity('Bravo', 'admin'))) == 0
+
+    service.handle_suscription({'user': 'admin', 'subscription': {'referential': {'providers': ['p1', 'p2']}}})
+    assert database.jobs.count_documents({}) == 0
+    assert bson.json_util.loads(service.get_entity_by_id('1', 'admin'))['id'] == '1'
+    assert len(bson.json_util.loads(service.search_entity('Alpha', 'admin', provider='p2'))) == 0
+
+    assert service.migrate_acl_mode('provider') == {'entities': 1, 'events': 0, 'search': 0}
+    assert database.entities.count_documents({'allowed_users': {'$exists': True}}) == 0
+    with pytest.raises(ReferentialServiceError):
+        service.migrate_acl_mode('denormalized')
+
+    report = service.compare_acl_modes('admin', samples=2)
+    assert report['collections']['entities']['provider']['matched'] == 2
+    assert report['collections']['entities']['allowed_users_entries'] == 0
+
+
+def test_add_informations_to_entity(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'}})
 
@@ -49,9 +375,7 @@ def test_add_informations_to_entity(database):
     assert result['informations']['starring'] == 'Bradley Cooper'
 
 
-def test_add_translation(database):
-    service = worker_factory(ReferentialService, database=database)
-
+def test_add_translation(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'}})
     database.entities.create_index('id')
@@ -67,9 +391,7 @@ def test_add_translation(database):
     assert result['internationalization']['fr'] == 'La gueule de bois'
 
 
-def test_delete_translation(database):
-    service = worker_factory(ReferentialService, database=database)
-
+def test_delete_translation(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'},
                                   'internationalization': {'fr': 'La gueule de bois'}})
@@ -77,12 +399,176 @@ def test_delete_translation(database):
 
     service.delete_translation_from_entity('0', 'fr')
     result = database.entities.find_one({'id': '0'})
-    assert 'internationalization' not in result
+    assert result['internationalization'] == {}
+
+
+def test_add_translation_missing_entity(database, service):
+    with pytest.raises(ReferentialServiceError):
+        service.add_translation_to_entity('0', 'fr', 'La gueule de bois')
+    with pytest.raises(ReferentialServiceError):
+        service.add_multiline_to_entity('0', {'line1': 'The'})
 
 
-def test_add_multiline(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_entity_write_buffer(database, service):
+    service.entity_writes.window = 1.
+    database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me', 'type': 'movie',
+                                  'internationalization': {'fr': 'La gueule de bois'}})
 
+    service.add_informations_to_entity('0', {'release_date': '2012-11-15'})
+    service.add_translation_to_entity('0', 'en', 'The hangover')
+    service.delete_translation_from_entity('0', 'fr')
+    service.add_multiline_to_entity('0', {'line1': 'The', 'line2': 'Hangover'})
+    ticket = service.delete_multiline_from_entity('0')['ticket']
+    assert 'informations' not in database.entities.find_one({'id': '0'})
+    status = service.get_entity_write_buffer_status()
+    assert status['pending'] == 1
+    assert status['acknowledged'] < ticket
+
+    result = service.flush_entity_writes()
+    assert result['flushed'] == 1
+    assert result['acknowledged'] >= ticket
+    entity = database.entities.find_one({'id': '0'})
+    assert entity['informations'] == {'release_date': '2012-11-15'}
+    assert entity['internationalization'] == {'en': 'The hangover'}
+    assert 'multiline' not in entity
+
+
+def test_entity_write_buffer_requeue(database):
+    database.entities.insert_many([{'id': 'bad', 'common_name': 'Bad'}, {'id': '0', 'common_name': 'Good'}])
+    buffer = EntityWriteBuffer(window=1.)
+    buffer.enqueue('bad', {'common_name.x': 1})
+    buffer.enqueue('0', {'informations.y': 1})
+    buffer.enqueue('0', {'informations': {'z': 2}})
+
+    result = buffer.flush(database.entities)
+    assert result['flushed'] == 1
+    assert [e['id'] for e in result['errors']] == ['bad']
+    assert buffer.status()['pending'] == 2
+
+    buffer.enqueue('0', {'informations.q': 3})
+    result = buffer.flush(database.entities)
+    assert result['flushed'] == 3
+    assert database.entities.find_one({'id': '0'})['informations'] == {'z': 2, 'q': 3}
+
+
+def test_changes_outbox(database, service):
+    service.add_entity('0', 'The Hangover', 'me', 'movie')
+    service.add_translation_to_entity('0', 'fr', 'La gueule de bois')
+    service.add_event('ev0', '2017-09-25T08:00:00', 'me', 'match', 'A - B', {}, [{'id': '0'}])
+    service.add_labels([('0', 'fr', 'ctx', 'Nom'), ('1', 'fr', 'ctx', 'Prénom')])
+
+    result = bson.json_util.loads(service.get_changes_since(0))
+    assert [(c['version'], c['kind'], c['id'], c['op']) for c in result['changes']] == [
+        (1, 'entity', '0', 'upsert'), (2, 'entity', '0', 'update'), (3, 'event', 'ev0', 'upsert'),
+        (4, 'label', '0', 'upsert'), (5, 'label', '1', 'upsert')]
+    assert result['changes'][0]['fields'] == ['common_name', 'provider', 'type']
+    assert result['changes'][1]['fields'] == ['internationalization.fr']
+    assert result['version'] == result['latest'] == 5
+
+    result = bson.json_util.loads(service.get_changes_since(3, limit=1))
+    assert [c['version'] for c in result['changes']] == [4]
+    assert result['version'] == 4
+
+    assert service.relay_changes() == 5
+    assert service.dispatch.call_count == 3
+    assert service.relay_changes() == 0
+    assert database.changes.count_documents({'dispatched': False}) == 0
+
+    service.get_entity_by_id('0', 'admin')
+    service.invalidate_changed_entries({'changes': [{'kind': 'entity', 'id': '0'}]})
+    assert service.get_response_cache_stats()['size'] == 0
+
+
+def test_changes_since_waits_for_gaps(database, service):
+    now = datetime.datetime.utcnow()
+    database.changes.insert_many([
+        {'version': 1, 'kind': 'entity', 'id': '0', 'op': 'upsert', 'at': now, 'dispatched': False},
+        {'version': 3, 'kind': 'entity', 'id': '1', 'op': 'upsert', 'at': now, 'dispatched': False}
+    ])
+    database.counters.insert_one({'_id': 'changes', 'version': 3})
+
+    result = bson.json_util.loads(service.get_changes_since(0))
+    assert [c['version'] for c in result['changes']] == [1]
+    assert result['version'] == 1
+    assert bson.json_util.loads(service.get_changes_since(1))['changes'] == []
+
+    database.changes.insert_one({'version': 2, 'kind': 'entity', 'id': '2', 'op': 'upsert', 'at': now,
+                                 'dispatched': False})
+    assert [c['version'] for c in bson.json_util.loads(service.get_changes_since(1))['changes']] == [2, 3]
+
+    database.changes.insert_one({'version': 5, 'kind': 'entity', 'id': '3', 'op': 'upsert',
+                                 'at': now - datetime.timedelta(minutes=5), 'dispatched': False})
+    assert [c['version'] for c in bson.json_util.loads(service.get_changes_since(3))['changes']] == [5]
+
+
+def test_routing(database):
+    routing = Routing()
+    routing.container = Mock(config={'MONGODB_ROUTING': {
+        'read_preference': 'secondaryPreferred', 'read_concern': 'local', 'max_staleness_seconds': 120,
+        'max_time_ms': 1000,
+        'rpcs': {'fuzzy_search': {'max_time_ms': 50}, 'get_changes_since': {'read_preference': 'primary'}}
+    }})
+    routing.setup()
+
+    def route(method_name):
+        return routing.get_dependency(Mock(entrypoint=Mock(method_name=method_name)))
+
+    entities = route('get_entity_by_id').collection(database, 'entities')
+    assert entities.max_time_ms == 1000
+    assert entities.read_preference == read_preference('secondaryPreferred', 120)
+    assert entities.read_concern.level == 'local'
+    assert route('fuzzy_search').max_time_ms == 50
+    assert route('get_changes_since').read_preference == read_preference('primary')
+    assert route('add_entity').read_preference is None
+    assert route('add_entity').collection(database, 'entities').read_preference == read_preference('primary')
+    assert routing.route('fuzzy_search') is route('fuzzy_search')
+
+    database.entities.insert_one({'id': '0', 'common_name': 'Name', 'allowed_users': ['admin']})
+    service = worker_factory(ReferentialService, database=database, config={},
+                             response_cache=LRUCache(), routing=route('get_entity_by_id'))
+    assert bson.json_util.loads(service.get_entity_by_id('0', 'admin'))['common_name'] == 'Name'
+
+    with pytest.raises(ExecutionTimeout):
+        list(BudgetedCollection(database.entities, 1).find({'$where': 'sleep(50) || true'}))
+
+
+def test_views(database, service):
+    database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me', 'type': 'movie',
+                                  'informations': {'starring': 'Bradley Cooper'}, 'allowed_users': ['admin']})
+    database.events.insert_many([
+        {'id': str(i), 'date': datetime.datetime(2018, 1, 1 + i), 'provider': 'me', 'type': 'match',
+         'common_name': 'A - B', 'content': {'score': [i, 0]}, 'entities': [{'id': '0', 'common_name': 'A'}],
+         'allowed_users': ['admin']} for i in range(3)])
+
+    full = bson.json_util.loads(service.get_entity_by_id('0', 'admin'))
+    summary = bson.json_util.loads(service.get_entity_by_id('0', 'admin', view='summary'))
+    assert 'informations' in full
+    assert summary == {'id': '0', 'common_name': 'The Hangover', 'provider': 'me', 'type': 'movie'}
+    assert service.get_response_cache_stats()['size'] == 2
+
+    events = bson.json_util.loads(service.get_events_by_entity_id('0', 'admin', view='summary'))
+    assert [e['id'] for e in events] == ['2', '1', '0']
+    assert events[0]['entities'] == [{'id': '0'}]
+    assert all('content' not in e for e in events)
+
+    page = bson.json_util.loads(service.get_events_between_dates('2018-01-01', '2018-01-31', 'admin', page_size=2,
+                                                                 view=['common_name']))
+    assert [sorted(e) for e in page['items']] == [['common_name', 'date', 'id']] * 2
+    assert [e['id'] for e in page['items']] == ['0', '1']
+    page = bson.json_util.loads(service.get_events_between_dates('2018-01-01', '2018-01-31', 'admin', page_size=2,
+                                                                 page_token=page['next_token'], view=['common_name']))
+    assert [e['id'] for e in page['items']] == ['2']
+
+    event = bson.json_util.loads(service.get_event_by_id('0', 'admin', view=['content', 'allowed_users']))
+    assert event == {'content': {'score': [0, 0]}}
+
+    with pytest.raises(ReferentialServiceError):
+        service.get_events_by_name('A', 'admin', view='unknown')
+    with pytest.raises(ReferentialServiceError):
+        service.get_event_by_id('0', 'admin', view=['allowed_users'])
+
+
+def test_add_multiline(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'}})
     database.entities.create_index('id')
@@ -93,9 +579,7 @@ def test_add_multiline(database):
     assert result['multiline']['line2'] == 'Hangover'
 
 
-def test_delete_multiline(database):
-    service = worker_factory(ReferentialService, database=database)
-
+def test_delete_multiline(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'},
                                   'multiline': {'line1': 'The', 'line2': 'Hangover'}})
@@ -106,9 +590,7 @@ def test_delete_multiline(database):
     assert 'multiline' not in result
 
 
-def test_get_entity_by_id(database):
-    service = worker_factory(ReferentialService, database=database)
-
+def test_get_entity_by_id(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'},
                                   'allowed_users': ['admin']})
@@ -118,8 +600,27 @@ def test_get_entity_by_id(database):
     assert result['common_name'] == 'The Hangover'
 
 
-def test_get_entity_by_name(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_get_entity_by_id_cache(database, service):
+    database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
+                                  'type': 'movie', 'allowed_users': ['admin']})
+
+    assert bson.json_util.loads(service.get_entity_by_id('0', 'admin'))['common_name'] == 'The Hangover'
+    assert bson.json_util.loads(service.get_entity_by_id('0', 'admin'))['common_name'] == 'The Hangover'
+    stats = service.get_response_cache_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+    service.add_informations_to_entity('0', {'starring': 'Bradley Cooper'})
+    result = bson.json_util.loads(service.get_entity_by_id('0', 'admin'))
+    assert result['informations']['starring'] == 'Bradley Cooper'
+
+    service.get_entity_by_id('0', 'other')
+    service.handle_suscription({'user': 'other', 'subscription': {'referential': {'providers': ['me']}}})
+    assert bson.json_util.loads(service.get_entity_by_id('0', 'other'))['id'] == '0'
+    assert service.get_response_cache_stats()['size'] == 2
+
+
+def test_get_entity_by_name(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'},
                                   'internationalization': [{'language': 'fr', 'translation': 'la gueule de bois'}],
@@ -141,17 +642,32 @@ def test_get_entity_by_name(database):
     assert len(result) == 0
 
 
-def test_add_event(database):
-    service = worker_factory(ReferentialService, database=database)
-
+def test_add_event(database, service):
     service.add_event('0', datetime.datetime.now().isoformat(), 'provider', 'type', 'Name', 'New Movie', ['Bradley'])
 
     result = database.events.find_one({'id': '0'})
     assert result['id'] == '0'
 
 
-def test_get_event_by_id(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_add_events_bulk(database, service):
+    database.subscriptions.insert_one({'user': 'admin', 'subscription': {'providers': ['provider']}})
+
+    res = service.add_events_bulk([
+        {'id': '0', 'date': '2018-05-07T14:30:00', 'provider': 'provider', 'type': 'type',
+         'common_name': 'Name', 'content': 'New Movie', 'entities': ['Bradley']},
+        {'id': '1', 'date': 'not a date', 'provider': 'provider', 'type': 'type',
+         'common_name': 'Name', 'content': 'New Movie', 'entities': ['Bradley']}
+    ])
+    assert res[0] == {'id': '0', 'status': 'ok'}
+    assert res[1]['status'] == 'error'
+
+    result = database.events.find_one({'id': '0'})
+    assert result['date'] == datetime.datetime(2018, 5, 7, 14, 30)
+    assert result['allowed_users'] == ['admin']
+    assert not database.events.find_one({'id': '1'})
+
+
+def test_get_event_by_id(database, service):
     database.events.insert_one({
         'id': '0',
         'date': datetime.datetime.now(),
@@ -166,8 +682,38 @@ def test_get_event_by_id(database):
     assert event['id'] == '0'
 
 
-def test_get_events_between_dates(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_get_event_by_id_encodings(database, service):
+    database.events.insert_one({
+        'id': '0',
+        'date': datetime.datetime(2018, 5, 7, 14, 30),
+        'provider': 'provider',
+        'type': 'type',
+        'common_name': 'Name',
+        'content': 'New Movie',
+        'entities': [{'common_name': 'Bradley', 'id': 'b1'}],
+        'allowed_users': ['admin']
+    })
+    event = json.loads(service.get_event_by_id('0', 'admin', encoding='json'))
+    assert event['date'] == '2018-05-07T14:30:00'
+
+    event = bson.BSON(base64.b64decode(service.get_event_by_id('0', 'admin', encoding='bson'))).decode()['result']
+    assert event['date'] == datetime.datetime(2018, 5, 7, 14, 30)
+
+    service.config['RESPONSE_ENCODING'] = 'json'
+    events = json.loads(service.get_events_between_dates('2018-05-07', '2018-05-15', 'admin'))
+    assert events[0]['id'] == '0'
+
+    with pytest.raises(ReferentialServiceError):
+        service.get_event_by_id('0', 'admin', encoding='xml')
+
+    page = json.loads(get_encoder('json')({'items': [{'_id': ObjectId(), 'id': '0', 'entities': [{'_id': ObjectId()}]}],
+                                           'next_token': None}))
+    assert page == {'items': [{'id': '0', 'entities': [{}]}], 'next_token': None}
+    database.jobs.insert_one({'_id': 'job', 'status': 'done'})
+    assert json.loads(service.get_job('job', encoding='json')) == {'_id': 'job', 'status': 'done'}
+
+
+def test_get_events_between_dates(database, service):
     database.events.insert_one({
         'id': '0',
         'date': datetime.datetime(2018, 5, 7, 14, 30),
@@ -186,8 +732,7 @@ def test_get_events_between_dates(database):
     assert len(events) == 0
 
 
-def test_get_events_by_entity_id(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_get_events_by_entity_id(database, service):
     database.events.insert_many([
         {
             'id': '0',
@@ -227,8 +772,7 @@ def test_get_events_by_entity_id(database):
     assert len(result) == 1
 
 
-def test_get_events_by_entity_id(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_get_events_by_entity_id(database, service):
     database.events.insert_many([
         {
             'id': '0',
@@ -269,8 +813,45 @@ def test_get_events_by_entity_id(database):
     assert not result
 
 
-def test_get_events_by_name(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_get_events_between_dates_paginated(database, service):
+    database.events.insert_many([{
+        'id': str(i),
+        'date': datetime.datetime(2018, 5, 7 + i // 2, 14, 30),
+        'provider': 'provider',
+        'type': 'type',
+        'common_name': 'Name',
+        'content': 'New Movie',
+        'entities': [{'common_name': 'Bradley', 'id': 'b1'}],
+        'allowed_users': ['admin']
+    } for i in range(5)])
+
+    ids = []
+    page_token = None
+    while True:
+        page = bson.json_util.loads(service.get_events_between_dates(
+            '2018-05-07', '2018-05-15', 'admin', page_size=2, page_token=page_token))
+        assert len(page['items']) <= 2
+        ids.extend(e['id'] for e in page['items'])
+        page_token = page['next_token']
+        if page_token is None:
+            break
+    assert ids == ['0', '1', '2', '3', '4']
+
+    page = bson.json_util.loads(service.get_events_by_entity_id('b1', 'admin', page_size=3))
+    assert [e['id'] for e in page['items']] == ['4', '3', '2']
+    page = bson.json_util.loads(service.get_events_by_entity_id('b1', 'admin', page_size=3,
+                                                                page_token=page['next_token']))
+    assert [e['id'] for e in page['items']] == ['1', '0']
+    assert page['next_token'] is None
+
+    with pytest.raises(ReferentialServiceError):
+        service.get_events_by_entity_id('b1', 'admin', page_size=3, page_token='garbage')
+    for page_size in (0, -1, '3'):
+        with pytest.raises(ReferentialServiceError):
+            service.get_events_by_entity_id('b1', 'admin', page_size=page_size)
+
+
+def test_get_events_by_name(database, service):
     database.events.create_index([('common_name', TEXT)], default_language='english')
     database.events.insert_one({
         'id': '0',
@@ -287,8 +868,7 @@ def test_get_events_by_name(database):
     assert res[0]['id'] == '0'
 
 
-def test_add_picture_to_entity(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_add_picture_to_entity(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'}})
     database.entities.create_index('id')
@@ -298,13 +878,52 @@ def test_add_picture_to_entity(database):
 
     service.add_picture_to_entity('0', 'mycontext', 'myformat', pic)
     fs = gridfs.GridFS(database)
-    file = fs.find_one({'filename': filename})
+    picture = database.pictures.find_one({'_id': filename})
+    assert picture['blob'] == hashlib.sha256(base64.b64decode(pic)).hexdigest()
 
-    assert file
+    file = fs.get(picture['blob'])
+    assert file.read() == base64.b64decode(pic)
+    assert file.content_type == 'image/png'
 
+    service.add_picture_to_entity('0', 'othercontext', 'myformat', pic)
+    service.add_picture_to_entity('0', 'mycontext', 'myformat', pic)
+    assert database.fs.files.count_documents({}) == 1
+    assert database.fs.files.find_one({'_id': picture['blob']})['metadata']['refs'] == 2
 
-def test_delete_picture_from_entity(database):
-    service = worker_factory(ReferentialService, database=database)
+    service.delete_picture_from_entity('0', 'othercontext', 'myformat')
+    assert database.fs.files.find_one({'_id': picture['blob']})['metadata']['refs'] == 1
+    service.delete_picture_from_entity('0', 'mycontext', 'myformat')
+    assert database.fs.files.count_documents({}) == 0
+    assert database.fs.chunks.count_documents({}) == 0
+
+
+def test_concurrent_blob_upload(database, service):
+    database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
+                                  'type': 'movie', 'allowed_users': ['admin']})
+    data = b'\x89PNG\r\n\x1a\n' + bytes(300 * 1024)
+    digest = hashlib.sha256(data).hexdigest()
+
+    # Another upload of the same content claimed the blob and wrote its first chunk only
+    database.fs.files.insert_one({'_id': digest, 'filename': digest, 'length': len(data), 'chunkSize': 255 * 1024,
+                                  'uploadDate': datetime.datetime.utcnow(),
+                                  'metadata': {'encoding': 'raw', 'refs': 1, 'pending': True}})
+    database.fs.chunks.insert_one({'files_id': digest, 'n': 0, 'data': bson.Binary(data[:255 * 1024])})
+
+    service.add_picture_to_entity('0', 'mycontext', 'myformat', base64.b64encode(data).decode('ascii'))
+    assert database.fs.chunks.count_documents({'files_id': digest}) == 2
+    file = database.fs.files.find_one({'_id': digest})
+    assert file['metadata'] == {'encoding': 'raw', 'refs': 2}
+    assert gridfs.GridFS(database).get(digest).read() == data
+
+    # A release that died after flagging the blob is taken over once its deletion is stale
+    database.fs.files.update_one({'_id': digest}, {'$set': {
+        'metadata.refs': 0, 'metadata.deleting': datetime.datetime.utcnow() - datetime.timedelta(minutes=5)}})
+    service.add_picture_to_entity('0', 'othercontext', 'myformat', base64.b64encode(data).decode('ascii'))
+    assert database.fs.files.find_one({'_id': digest})['metadata'] == {'encoding': 'raw', 'refs': 1}
+    assert gridfs.GridFS(database).get(digest).read() == data
+
+
+def test_delete_picture_from_entity(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'}})
     database.entities.create_index('id')
@@ -324,8 +943,7 @@ def test_delete_picture_from_entity(database):
     assert not fs.find_one({'filename': filename})
 
 
-def test_get_entity_picture(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_get_entity_picture(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'},
                                   'allowed_users': ['admin']})
@@ -351,12 +969,82 @@ def test_get_entity_picture(database):
 
     assert entity_pic == pic
 
+    assert service.migrate_pictures() == 1
+    assert not fs.find_one({'filename': filename})
+    file = fs.get(database.pictures.find_one({'_id': filename})['blob'])
+    assert file.metadata['encoding'] == 'raw'
+    assert file.content_type == 'image/png'
+    assert file.read() == base64.b64decode(pic)
+
+    entity_pic = service.get_entity_picture('0', 'mycontext', 'myformat', 'admin')
+    assert entity_pic == pic
+
+    chunk = service.get_entity_picture_chunk('0', 'mycontext', 'myformat', 'admin', 0, 100)
+    assert chunk['length'] == len(base64.b64decode(pic))
+    assert not chunk['eof']
+    rest = service.get_entity_picture_chunk('0', 'mycontext', 'myformat', 'admin', 100, chunk['length'])
+    assert rest['eof']
+    assert base64.b64decode(chunk['content']) + base64.b64decode(rest['content']) == base64.b64decode(pic)
 
 
 
-def test_add_label(database):
-    service = worker_factory(ReferentialService, database=database)
 
+def test_get_entity_picture_if_modified(database, service):
+    database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'me',
+                                  'type': 'movie', 'allowed_users': ['admin']})
+    database.subscriptions.insert_one({'user': 'admin', 'subscription': {'pictures': ['mycontext']}})
+
+    pic = base64.b64encode(b'\x89PNG\r\n\x1a\n' + b'0' * 1000).decode('utf-8')
+    service.add_picture_to_entity('0', 'mycontext', 'myformat', pic)
+
+    res = service.get_entity_picture_if_modified('0', 'mycontext', 'myformat', 'admin')
+    assert res['status'] == 'ok'
+    assert res['content'] == pic
+    assert res['content_type'] == 'image/png'
+    assert res['hash'] == hashlib.sha256(base64.b64decode(pic)).hexdigest()
+
+    res = service.get_entity_picture_if_modified('0', 'mycontext', 'myformat', 'admin', res['hash'])
+    assert res['status'] == 'not_modified'
+
+    assert service.get_entity_picture('0', 'mycontext', 'myformat', 'admin') == pic
+    stats = service.get_picture_cache_stats()
+    assert stats['hits'] == 1
+    assert stats['weight'] == len(base64.b64decode(pic))
+
+    assert not service.get_entity_picture_if_modified('0', 'othercontext', 'myformat', 'admin')
+
+
+def test_get_entity_pictures(database, service):
+    database.entities.insert_many([
+        {'id': '0', 'common_name': 'The Hangover', 'provider': 'me', 'type': 'movie', 'allowed_users': ['admin']},
+        {'id': '1', 'common_name': 'Hidden', 'provider': 'other', 'type': 'movie', 'allowed_users': []}
+    ])
+    database.subscriptions.insert_one({'user': 'admin', 'subscription': {'pictures': ['mycontext']}})
+
+    pic = base64.b64encode(b'\x89PNG\r\n\x1a\n' + b'0' * 600000).decode('utf-8')
+    service.add_picture_to_entity('0', 'mycontext', 'myformat', pic)
+    service.add_picture_to_entity('0', 'mycontext', 'svg', '<svg></svg>', kind='vector')
+    service.add_picture_to_entity('1', 'mycontext', 'myformat', pic)
+
+    fs = gridfs.GridFS(database)
+    legacy = hashlib.sha1(''.join(['bitmap', '0', 'mycontext', 'legacy']).encode('utf-8')).hexdigest()
+    fs.put(binascii.hexlify(b'legacy'), filename=legacy)
+
+    res = service.get_entity_pictures([
+        {'id': '0', 'context': 'mycontext', 'format': 'myformat'},
+        {'id': '0', 'context': 'mycontext', 'format': 'svg', 'kind': 'vector'},
+        {'id': '0', 'context': 'mycontext', 'format': 'legacy'},
+        {'id': '0', 'context': 'othercontext', 'format': 'myformat'},
+        {'id': '1', 'context': 'mycontext', 'format': 'myformat'}
+    ], 'admin')
+    assert res['bitmap/0/mycontext/myformat'] == pic
+    assert res['vector/0/mycontext/svg'] == '<svg></svg>'
+    assert base64.b64decode(res['bitmap/0/mycontext/legacy']) == b'legacy'
+    assert res['bitmap/0/othercontext/myformat'] is None
+    assert res['bitmap/1/mycontext/myformat'] is None
+
+
+def test_add_label(database, service):
     service.add_label('0', 'fr', 'ctx', 'Label')
     lab = database.labels.find_one({'id': '0', 'language': 'fr', 'context': 'ctx'})
     assert lab['label'] == 'Label'
@@ -366,16 +1054,39 @@ def test_add_label(database):
     assert lab['label'] == 'Label2'
 
 
-def test_delete_label(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_delete_label(database, service):
     database.labels.insert_one({'id': '0', 'language': 'fr', 'context': 'ctx', 'label': 'Label'})
 
     service.delete_label('0', 'fr', 'ctx')
     assert not database.labels.find_one({'id': '0', 'language': 'fr', 'context': 'ctx'})
 
 
-def test_get_labels_by_id_and_language_and_context(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_add_and_delete_labels(database, service):
+    database.labels.insert_one({'id': '0', 'language': 'fr', 'context': 'ctx', 'label': 'Label'})
+
+    result = service.add_labels([
+        ('0', 'fr', 'ctx', 'Nom'),
+        {'id': '1', 'language': 'fr', 'context': 'ctx', 'label': 'Prénom'},
+        {'id': '2', 'language': 'fr'},
+        ['3', 'fr', 'ctx', 'Âge']
+    ], chunk_size=2)
+    assert result['upserted'] == 2
+    assert result['modified'] == 1
+    assert [e['index'] for e in result['errors']] == [2]
+    assert database.labels.find_one({'id': '0'})['label'] == 'Nom'
+    assert database.counters.find_one({'_id': 'labels'})['version'] == 3
+    assert len(service.get_labels_by_id(['0', '1', '3'])) == 3
+
+    database.labels.insert_one({'id': 'a', 'language': 'b', 'context': 'c', 'label': 'Kept'})
+    result = service.delete_labels([('0', 'fr', 'ctx'), ('1', 'fr', 'ctx', 'Prénom'), ('9', 'fr', 'ctx'), 'x', 'abc'])
+    assert result['deleted'] == 2
+    assert [e['index'] for e in result['errors']] == [3, 4]
+    assert database.labels.find_one({'id': 'a'})
+    assert database.label_tombstones.count_documents({}) == 3
+    assert [l['id'] for l in service.get_labels_by_id(['0', '1', '3'])] == ['3']
+
+
+def test_get_labels_by_id_and_language_and_context(database, service):
     database.labels.insert_one({'id': '0', 'language': 'fr', 'context': 'ctx', 'label': 'Label'})
     database.labels.insert_one({'id': '1', 'language': 'fr', 'context': 'ctx', 'label': 'Label2'})
 
@@ -386,8 +1097,7 @@ def test_get_labels_by_id_and_language_and_context(database):
     assert len(labs) == 2
 
 
-def test_get_labels_by_id(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_get_labels_by_id(database, service):
     database.labels.insert_one({'id': '0', 'language': 'fr', 'context': 'ctx', 'label': 'Nom'})
     database.labels.insert_one({'id': '0', 'language': 'en', 'context': 'ctx', 'label': 'Label'})
 
@@ -395,8 +1105,47 @@ def test_get_labels_by_id(database):
     assert len(labs) == 2
 
 
-def test_update_ngrams_search_collection(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_label_dictionary_reload_keeps_serving(database):
+    database.labels.insert_many([{'id': str(i), 'language': 'fr', 'context': 'ctx', 'label': str(i), 'version': i + 1}
+                                 for i in range(3)])
+    database.counters.insert_one({'_id': 'labels', 'version': 3})
+    labels = LabelDictionary(refresh_interval=0, reload_interval=0)
+    assert labels.refresh(database) == 3
+    seen = []
+
+    def find(*args):
+        for doc in database.labels.find(*args):
+            seen.append(labels.get('2', 'fr', 'ctx'))
+            yield doc
+
+    assert labels.refresh(Mock(counters=database.counters, labels=Mock(find=find))) == 3
+    assert len(seen) == 3
+    assert None not in seen
+
+
+def test_label_dictionary_refresh(database, service):
+    database.labels.insert_one({'id': '0', 'language': 'fr', 'context': 'ctx', 'label': 'Nom'})
+    assert service.get_labels_by_id_and_language_and_context('0', 'fr', 'ctx')['label'] == 'Nom'
+    assert service.get_labels_stats()['version'] == 0
+
+    service.add_label('0', 'en', 'ctx', 'Name')
+    service.add_label('1', 'fr', 'ctx', 'Prénom')
+    assert [l['label'] for l in service.get_labels_by_id('0')] == ['Nom', 'Name']
+    labs = service.get_labels_by_id_and_language_and_context(['1', '0', '1', '2'], 'fr', 'ctx')
+    assert [l['id'] for l in labs] == ['1', '0']
+    assert 'version' not in labs[0]
+
+    service.delete_label('0', 'en', 'ctx')
+    service.delete_label('0', 'en', 'ctx')
+    assert service.get_labels_stats()['version'] == 3
+    assert len(service.get_labels_by_id('0')) == 1
+
+    service.add_label('0', 'en', 'ctx', 'Name')
+    assert service.get_labels_by_id_and_language_and_context('0', 'en', 'ctx')['label'] == 'Name'
+    assert service.get_labels_stats()['size'] == 3
+
+
+def test_update_ngrams_search_collection(database, service):
     datetime.datetime(2017, 9, 25, 8, 0)
     database.events.insert_many([
         {
@@ -451,8 +1200,54 @@ def test_update_ngrams_search_collection(database):
         assert word in search_doc['prefix_ngrams']
 
 
-def test_update_entry_ngrams(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_update_ngrams_search_collection_incremental(database, service):
+    service.add_entity('en0', 'The Hangover', 'provider', 'movie')
+    service.add_event('ev0', '2017-09-25T08:00:00', 'provider', 'new movie', 'Name', 'New Movie', [])
+
+    res = service.update_ngrams_search_collection(incremental=True, batch_size=1)
+    assert not res['incremental']
+    assert res['processed'] == 2
+    assert 'run' not in database.referential_meta.find_one({'_id': 'ngrams'})
+
+    res = service.update_ngrams_search_collection(incremental=True)
+    assert res['incremental']
+    assert res['processed'] == 2
+
+    # A write stamped before the checkpoint but committed after the previous scan is still picked up
+    since = database.referential_meta.find_one({'_id': 'ngrams'})['since']
+    database.entities.insert_one({'id': 'en1', 'common_name': 'Late', 'provider': 'provider', 'type': 'movie',
+                                  'updated_at': since - datetime.timedelta(seconds=10)})
+    res = service.update_ngrams_search_collection(incremental=True)
+    assert res['processed'] == 3
+    assert database.search.find_one({'id': 'en1'})
+
+    service.config['SEARCH_INCREMENTAL_MARGIN'] = 0
+    res = service.update_ngrams_search_collection(incremental=True)
+    assert res['processed'] == 0
+
+    service.add_entity('en0', 'The Hangover Part II', 'provider', 'movie')
+    res = service.update_ngrams_search_collection(incremental=True)
+    assert res['processed'] == 1
+    assert 'part' in database.search.find_one({'id': 'en0'})['ngrams']
+
+
+def test_update_ngrams_search_collection_resume(database, service):
+    database.entities.insert_many([{'id': 'en{}'.format(i), 'common_name': 'Name {}'.format(i),
+                                    'provider': 'provider', 'type': 'movie', 'allowed_users': []}
+                                   for i in range(3)])
+    first = database.entities.find_one({'id': 'en0'})
+    database.referential_meta.insert_one({'_id': 'ngrams', 'run': {
+        'started_at': datetime.datetime(2017, 9, 25, 8, 0), 'since': None,
+        'collection': 'entities', 'last_id': first['_id'], 'processed': 1}})
+
+    res = service.update_ngrams_search_collection()
+    assert res['processed'] == 3
+    assert not database.search.find_one({'id': 'en0'})
+    assert database.search.count_documents({}) == 2
+    assert database.referential_meta.find_one({'_id': 'ngrams'})['since'] == datetime.datetime(2017, 9, 25, 8, 0)
+
+
+def test_update_entry_ngrams(database, service):
     datetime.datetime(2017, 9, 25, 8, 0)
     database.events.insert_many([
         {
@@ -491,8 +1286,7 @@ def test_update_entry_ngrams(database):
         service.update_entry_ngrams('unknwon')
 
 
-def test_search_entity(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_search_entity(database, service):
     database.entities.insert_one({'id': '0', 'common_name': 'The Hangover', 'provider': 'provider',
                                   'type': 'movie', 'informations': {'starring': 'Bradley Cooper'},
                                   'internationalization': [{'language': 'fr', 'translation': 'la gueule de bois'}],
@@ -511,8 +1305,7 @@ def test_search_entity(database):
     assert res[0]['common_name'] == 'The Hangover'
 
 
-def test_search_event(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_search_event(database, service):
     database.events.insert_many([
         {
             'id': '0',
@@ -556,8 +1349,7 @@ def test_search_event(database):
     assert res[0]['common_name'] == 'Name'
 
 
-def test_fuzzy_search(database):
-    service = worker_factory(ReferentialService, database=database)
+def test_fuzzy_search(database, service):
     database.search.insert_one(
         {
             'id': '0',
@@ -586,3 +1378,70 @@ def test_fuzzy_search(database):
 
     res = bson.json_util.loads(service.fuzzy_search('nam', 'admin', 'other', 'provider'))
     assert len(res) == 0
+
+
+def test_fuzzy_search_in_memory(database):
+    search_index = InMemorySearch(enabled=True, refresh_interval=0)
+    service = worker_factory(ReferentialService, database=database, config={},
+                             allowed_users_cache=ProviderUsersCache(), search_index=search_index,
+                             response_cache=LRUCache(), picture_cache=LRUCache(), routing=Route())
+    database.search.insert_many([
+        {'id': '0', 'common_name': 'Name', 'type': 'type', 'provider': 'provider', 'allowed_users': ['admin']},
+        {'id': '1', 'common_name': 'Surname', 'type': 'type', 'provider': 'provider', 'allowed_users': ['admin']},
+        {'id': '2', 'common_name': 'Name', 'type': 'type', 'provider': 'provider', 'allowed_users': ['other']}
+    ])
+
+    res = bson.json_util.loads(service.fuzzy_search('nam', 'admin'))
+    assert [r['id'] for r in res] == ['0', '1']
+    assert res[0]['score'] > res[1]['score']
+
+    res = bson.json_util.loads(service.fuzzy_search('nam', 'admin', limit=1))
+    assert [r['id'] for r in res] == ['0']
+
+    res = bson.json_util.loads(service.fuzzy_search('nam', 'admin', 'other', 'provider'))
+    assert len(res) == 0
+
+    database.search.update_one({'id': '1'}, {'$set': {'common_name': 'Other', 'updated_at': datetime.datetime.utcnow()}})
+    res = bson.json_util.loads(service.fuzzy_search('nam', 'admin'))
+    assert [r['id'] for r in res] == ['0']
+
+    # Committed after the watermark moved on but stamped before it
+    database.search.update_one({'id': '2'}, {'$set': {
+        'allowed_users': ['other', 'admin'], 'updated_at': search_index.last_stamp - datetime.timedelta(seconds=10)}})
+    res = bson.json_util.loads(service.fuzzy_search('nam', 'admin'))
+    assert sorted(r['id'] for r in res) == ['0', '2']
+
+    # Removals without a stamp, e.g. a snapshot import, are picked up by the periodic full reload
+    database.search.delete_one({'id': '0'})
+    search_index.reload_interval = 0
+    res = bson.json_util.loads(service.fuzzy_search('nam', 'admin'))
+    assert [r['id'] for r in res] == ['2']
+
+
+def test_hashed_search_format(database, service):
+    database.entities.insert_many([
+        {'id': '0', 'common_name': 'Name', 'type': 'type', 'provider': 'provider', 'allowed_users': ['admin']},
+        {'id': '1', 'common_name': 'Surname', 'type': 'type', 'provider': 'provider', 'allowed_users': ['admin']}
+    ])
+    service.update_ngrams_search_collection()
+
+    report = service.compare_search_formats(['nam'])
+    assert report['documents'] == 2
+    assert report['hashed_bytes_per_document'] < report['text_bytes_per_document']
+    assert report['recall'] == 1.
+
+    assert service.migrate_search_documents('hashed') == 2
+    search_doc = database.search.find_one({'id': '0'})
+    assert 'ngrams' not in search_doc
+    assert search_doc['trigrams']
+
+    service.config['SEARCH_FORMAT'] = 'hashed'
+    res = bson.json_util.loads(service.fuzzy_search('nam', 'admin'))
+    assert [r['id'] for r in res] == ['0', '1']
+    assert res[0]['score'] == 300
+
+    res = bson.json_util.loads(service.fuzzy_search('nam', 'admin', 'type', 'provider', 1))
+    assert [r['id'] for r in res] == ['0']
+
+    res = bson.json_util.loads(service.fuzzy_search('nam', 'other'))
+    assert len(res) == 0
@@ -0,0 +1,42 @@
+import argparse
+import json
+import random
+import time
+
+from application.encoders import ENCODERS
+from benchmarks.dataset import make_entity, make_event
+
+
+def bench(encoder, docs, repeat):
+    payload = encoder(docs)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encoder(docs)
+    elapsed = time.perf_counter() - start
+    return {
+        'bytes': len(payload),
+        'calls_per_second': repeat / elapsed,
+        'documents_per_second': repeat * len(docs) / elapsed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare response encoders on synthetic referential documents')
+    parser.add_argument('--documents', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    datasets = {
+        'entities': [make_entity(rnd, i) for i in range(args.documents)],
+        'events': [make_event(rnd, i) for i in range(args.documents)]
+    }
+
+    results = dict((name, dict((encoding, bench(encoder, docs, args.repeat)) for encoding, encoder in ENCODERS.items()))
+                   for name, docs in datasets.items())
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+import argparse
+import datetime
+import json
+import platform
+import random
+import subprocess
+import time
+from pymongo import MongoClient
+from nameko.testing.services import worker_factory
+
+from application.services.referential import ReferentialService
+from application.indexes import ensure_indexes
+from application.dependencies.allowed_users import ProviderUsersCache
+from application.dependencies.search_index import InMemorySearch
+from application.dependencies.cache import LRUCache
+from application.dependencies.jobs import BackgroundJobs
+from application.dependencies.labels import LabelDictionary
+from application.dependencies.metrics import MetricsRegistry
+from application.dependencies.write_buffer import EntityWriteBuffer
+from application.dependencies.outbox import Outbox
+from application.dependencies.routing import Routing
+from benchmarks.dataset import populate, make_picture, random_word
+
+
+def percentile(timings, p):
+    return timings[min(len(timings) - 1, int(p / 100. * len(timings)))]
+
+
+def measure(fn, rnd, samples, warmup=3):
+    for _ in range(warmup):
+        fn(rnd)
+    timings = []
+    start = time.perf_counter()
+    for _ in range(samples):
+        call = time.perf_counter()
+        fn(rnd)
+        timings.append((time.perf_counter() - call) * 1000)
+    elapsed = time.perf_counter() - start
+    timings.sort()
+    return {
+        'samples': samples,
+        'p50_ms': percentile(timings, 50),
+        'p90_ms': percentile(timings, 90),
+        'p99_ms': percentile(timings, 99),
+        'max_ms': timings[-1],
+        'throughput': samples / elapsed
+    }
+
+
+def make_service(database, config):
+    # Dependencies are built from the config the same way their providers do, so --config is honoured
+    routing = Routing()
+    routing.configure(config)
+    service = worker_factory(
+        ReferentialService, database=database, config=config,
+        allowed_users_cache=ProviderUsersCache(config.get('ALLOWED_USERS_CACHE_TTL', 300)),
+        search_index=InMemorySearch(enabled=config.get('SEARCH_ENGINE', 'mongo') == 'memory',
+                                    refresh_interval=config.get('SEARCH_INDEX_REFRESH_INTERVAL', 1.),
+                                    reload_interval=config.get('SEARCH_INDEX_RELOAD_INTERVAL', 300.),
+                                    margin=config.get('SEARCH_INCREMENTAL_MARGIN', 300.)),
+        response_cache=LRUCache(config.get('RESPONSE_CACHE_SIZE', 10000), config.get('RESPONSE_CACHE_TTL', 60)),
+        picture_cache=LRUCache(config.get('PICTURE_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+                               config.get('PICTURE_CACHE_TTL', 24 * 60 * 60), weigh=lambda value: len(value[1])),
+        jobs=BackgroundJobs(),
+        labels=LabelDictionary(config.get('LABELS_REFRESH_INTERVAL', 1.), config.get('LABELS_RELOAD_INTERVAL', 300.)),
+        entity_writes=EntityWriteBuffer(config.get('ENTITY_WRITE_BUFFER_WINDOW', 0.)),
+        metrics=MetricsRegistry(),
+        outbox=Outbox(config.get('CHANGES_RELAY_BATCH_SIZE', 500), config.get('CHANGES_GAP_TIMEOUT', 60.)),
+        routing=routing.default_write)
+    return service, routing
+
+
+def via(rpc, fn):
+    fn.rpc = rpc
+    return fn
+
+
+def scenarios(scale):
+    def entity(rnd):
+        return 'en{}'.format(rnd.randrange(scale['entities']))
+
+    def event(rnd):
+        return 'ev{}'.format(rnd.randrange(scale['events']))
+
+    def user(rnd):
+        return 'user{}'.format(rnd.randrange(scale['users']))
+
+    def provider(rnd):
+        return 'provider{}'.format(rnd.randrange(scale['providers']))
+
+    def date(rnd):
+        return (datetime.datetime(2018, 1, 1) + datetime.timedelta(days=rnd.randrange(365))).isoformat()
+
+    def labels(rnd, size=200):
+        return [entity(rnd) for _ in range(size)]
+
+    pictures = []
+
+    def picture_if_modified(s, rnd):
+        # Known pictures are loaded once, during warmup, so the not modified path is what gets measured
+        if not pictures:
+            pictures.extend(s.database.pictures.find({}, {'id': 1, 'context': 1, 'format': 1, 'blob': 1, '_id': 0}))
+        if not pictures:
+            return None
+        p = rnd.choice(pictures)
+        return s.get_entity_picture_if_modified(p['id'], p['context'], p['format'], user(rnd), known_hash=p['blob'])
+
+    def version(s, rnd):
+        return rnd.randrange(max(1, Outbox.latest(s.database)))
+
+    return {
+        'get_entity_by_id': lambda s, rnd: s.get_entity_by_id(entity(rnd), user(rnd)),
+        'get_entities_by_name': lambda s, rnd: s.get_entities_by_name(random_word(rnd, 3), user(rnd), page_size=50),
+        'search_entity': lambda s, rnd: s.search_entity(random_word(rnd, 4), user(rnd), type='player'),
+        'fuzzy_search': lambda s, rnd: s.fuzzy_search(random_word(rnd, 4), user(rnd), limit=20),
+        'get_event_by_id': lambda s, rnd: s.get_event_by_id(event(rnd), user(rnd)),
+        'get_events_by_entity_id': lambda s, rnd: s.get_events_by_entity_id(entity(rnd), user(rnd)),
+        'get_events_by_entity_id_paginated': via('get_events_by_entity_id', lambda s, rnd: s.get_events_by_entity_id(
+            entity(rnd), user(rnd), page_size=20)),
+        'get_events_by_entity_id_summary': via('get_events_by_entity_id', lambda s, rnd: s.get_events_by_entity_id(
+            entity(rnd), user(rnd), view='summary')),
+        'get_event_filtered_by_entities': lambda s, rnd: s.get_event_filtered_by_entities(
+            event(rnd), [entity(rnd)], user(rnd)),
+        'get_events_by_name': lambda s, rnd: s.get_events_by_name(random_word(rnd, 8), user(rnd), page_size=50),
+        'get_events_between_dates': lambda s, rnd: s.get_events_between_dates(
+            date(rnd), date(rnd), user(rnd), page_size=100),
+        'get_events_between_dates_summary': via('get_events_between_dates', lambda s, rnd: s.get_events_between_dates(
+            date(rnd), date(rnd), user(rnd), page_size=100, view='summary')),
+        'search_event': lambda s, rnd: s.search_event(random_word(rnd, 8), date(rnd), user(rnd)),
+        'get_labels_by_id_and_language_and_context': lambda s, rnd: s.get_labels_by_id_and_language_and_context(
+            labels(rnd), 'fr', 'name'),
+        'get_labels_by_id': lambda s, rnd: s.get_labels_by_id(labels(rnd)),
+        'get_entity_picture': lambda s, rnd: s.get_entity_picture(entity(rnd), 'default', 'png', user(rnd)),
+        'get_entity_pictures': lambda s, rnd: s.get_entity_pictures(
+            [{'id': entity(rnd), 'context': 'default', 'format': 'png'} for _ in range(20)], user(rnd)),
+        'get_entity_picture_chunk': lambda s, rnd: s.get_entity_picture_chunk(
+            entity(rnd), 'default', 'png', user(rnd)),
+        'get_entity_picture_if_modified': picture_if_modified,
+        'get_changes_since': lambda s, rnd: s.get_changes_since(version(s, rnd), limit=100),
+        'add_entity': lambda s, rnd: s.add_entity(entity(rnd), random_word(rnd, 10), provider(rnd), 'player'),
+        'add_entities_bulk': lambda s, rnd: s.add_entities_bulk([
+            {'id': entity(rnd), 'common_name': random_word(rnd, 10), 'provider': provider(rnd), 'type': 'player'}
+            for _ in range(100)]),
+        'add_informations_to_entity': lambda s, rnd: s.add_informations_to_entity(
+            entity(rnd), {random_word(rnd, 6): random_word(rnd, 12)}),
+        'add_translation_to_entity': lambda s, rnd: s.add_translation_to_entity(entity(rnd), 'it', random_word(rnd, 12)),
+        'add_multiline_to_entity': lambda s, rnd: s.add_multiline_to_entity(
+            entity(rnd), {'line1': random_word(rnd, 12), 'line2': random_word(rnd, 12)}),
+        'add_event': lambda s, rnd: s.add_event(event(rnd), date(rnd), provider(rnd), 'match', random_word(rnd, 8),
+                                                {'score': [0, 0]}, [{'id': entity(rnd)}]),
+        'add_events_bulk': lambda s, rnd: s.add_events_bulk([
+            {'id': event(rnd), 'date': date(rnd), 'provider': provider(rnd), 'type': 'match',
+             'common_name': random_word(rnd, 8), 'content': {'score': [0, 0]}, 'entities': [{'id': entity(rnd)}]}
+            for _ in range(100)]),
+        'add_picture_to_entity': lambda s, rnd: s.add_picture_to_entity(
+            entity(rnd), 'default', 'png', make_picture(rnd, 20 * 1024)),
+        'add_label': lambda s, rnd: s.add_label(entity(rnd), 'fr', 'name', random_word(rnd, 12)),
+        'add_labels': lambda s, rnd: s.add_labels(
+            [(entity(rnd), 'en', 'name', random_word(rnd, 12)) for _ in range(1000)]),
+        'handle_suscription': lambda s, rnd: s.handle_suscription({'user': user(rnd), 'subscription': {
+            'referential': {'providers': [provider(rnd) for _ in range(5)]}}}),
+        'update_entry_ngrams': lambda s, rnd: s.update_entry_ngrams(entity(rnd)),
+        # Deletions run last so they do not thin out the data the other scenarios read
+        'delete_translation_from_entity': lambda s, rnd: s.delete_translation_from_entity(entity(rnd), 'it'),
+        'delete_multiline_from_entity': lambda s, rnd: s.delete_multiline_from_entity(entity(rnd)),
+        'delete_picture_from_entity': lambda s, rnd: s.delete_picture_from_entity(entity(rnd), 'default', 'png'),
+        'delete_label': lambda s, rnd: s.delete_label(entity(rnd), 'fr', 'name'),
+        'delete_labels': lambda s, rnd: s.delete_labels([(entity(rnd), 'en', 'name') for _ in range(1000)]),
+        '_make_ngrams': lambda s, rnd: s._make_ngrams(' '.join(random_word(rnd, rnd.randint(3, 10)) for _ in range(3)))
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark referential RPCs against a synthetic referential')
+    parser.add_argument('--db-url', default='mongodb://localhost:27017')
+    parser.add_argument('--db-name', default='referential_benchmark')
+    parser.add_argument('--entities', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--labels', type=int, default=20000)
+    parser.add_argument('--pictures', type=int, default=200)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--providers', type=int, default=40)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', type=json.loads, default={}, help='Service config as a JSON object')
+    parser.add_argument('--only', nargs='*', help='Scenario names to run')
+    parser.add_argument('--keep', action='store_true', help='Keep the benchmark database')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    client = MongoClient(args.db_url)
+    client.drop_database(args.db_name)
+    database = client[args.db_name]
+    rnd = random.Random(args.seed)
+    service, routing = make_service(database, args.config)
+
+    try:
+        start = time.perf_counter()
+        ensure_indexes(database, force=True)
+        scale = populate(database, service, rnd, args.entities, args.events, args.labels, args.pictures,
+                         args.users, args.providers)
+        results = {'populate': {'elapsed': time.perf_counter() - start}}
+
+        service.routing = routing.route('update_ngrams_search_collection')
+        for incremental in (False, True):
+            results['update_ngrams_search_collection' + ('_incremental' if incremental else '')] = \
+                service.update_ngrams_search_collection(incremental=incremental)
+
+        for name, fn in scenarios(scale).items():
+            if args.only and name not in args.only:
+                continue
+            service.routing = routing.route(getattr(fn, 'rpc', name))
+            results[name] = measure(lambda r: fn(service, r), rnd, args.samples)
+
+        report = {
+            'meta': {
+                'revision': git_revision(),
+                'timestamp': datetime.datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'mongodb': client.server_info()['version'],
+                'seed': args.seed,
+                'samples': args.samples,
+                'config': args.config,
+                'scale': scale
+            },
+            'results': results
+        }
+    finally:
+        if not args.keep:
+            client.drop_database(args.db_name)
+        client.close()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
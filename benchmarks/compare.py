@@ -0,0 +1,57 @@
+import argparse
+import json
+import sys
+
+
+METRICS = (('p50_ms', False), ('p99_ms', False), ('throughput', True))
+
+
+def compare(baseline, candidate, threshold):
+    rows = []
+    for name in sorted(set(baseline['results']) & set(candidate['results'])):
+        before = baseline['results'][name]
+        after = candidate['results'][name]
+        for metric, higher_is_better in METRICS:
+            if not before.get(metric) or after.get(metric) is None:
+                continue
+            change = (after[metric] - before[metric]) / before[metric]
+            regression = -change if higher_is_better else change
+            rows.append({
+                'name': name,
+                'metric': metric,
+                'baseline': before[metric],
+                'candidate': after[metric],
+                'change': change,
+                'regression': regression > threshold
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change reported as a regression')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows = compare(baseline, candidate, args.threshold)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print('{:<45} {:<12} {:>12} {:>12} {:>8}'.format('name', 'metric', 'baseline', 'candidate', 'change'))
+        for row in rows:
+            print('{:<45} {:<12} {:>12.3f} {:>12.3f} {:>+7.1%}{}'.format(
+                row['name'], row['metric'], row['baseline'], row['candidate'], row['change'],
+                ' !' if row['regression'] else ''))
+
+    sys.exit(1 if any(row['regression'] for row in rows) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import base64
+import datetime
+import string
+from bson.objectid import ObjectId
+
+
+def random_word(rnd, size):
+    return ''.join(rnd.choice(string.ascii_lowercase) for _ in range(size))
+
+
+def make_entity(rnd, i, providers=40):
+    return {
+        '_id': ObjectId(),
+        'id': 'en{}'.format(i),
+        'common_name': ' '.join(random_word(rnd, rnd.randint(3, 10)) for _ in range(rnd.randint(1, 3))),
+        'provider': 'provider{}'.format(rnd.randint(0, providers)),
+        'type': rnd.choice(['player', 'team', 'venue']),
+        'informations': dict((random_word(rnd, 6), random_word(rnd, 12)) for _ in range(10)),
+        'internationalization': dict((lang, random_word(rnd, 12)) for lang in ('fr', 'en', 'es', 'de')),
+        'updated_at': datetime.datetime.utcnow()
+    }
+
+
+def make_event(rnd, i, providers=40, entities=1000):
+    return {
+        '_id': ObjectId(),
+        'id': 'ev{}'.format(i),
+        'date': datetime.datetime(2018, 1, 1) + datetime.timedelta(hours=rnd.randint(0, 24 * 365)),
+        'provider': 'provider{}'.format(rnd.randint(0, providers)),
+        'type': 'match',
+        'common_name': '{} - {}'.format(random_word(rnd, 8), random_word(rnd, 8)),
+        'content': {
+            'score': [rnd.randint(0, 5), rnd.randint(0, 5)],
+            'stats': [{'name': random_word(rnd, 8), 'value': rnd.random(), 'at': datetime.datetime.utcnow()}
+                      for _ in range(30)]
+        },
+        'entities': [{'id': 'en{}'.format(rnd.randint(0, entities - 1)), 'common_name': random_word(rnd, 10)}
+                     for _ in range(22)],
+        'updated_at': datetime.datetime.utcnow()
+    }
+
+
+def make_label(rnd, i, language, context):
+    return {'id': 'en{}'.format(i), 'language': language, 'context': context, 'label': random_word(rnd, 12), 'version': 0}
+
+
+def make_subscription(rnd, user, providers, contexts):
+    return {
+        'user': user,
+        'subscription': {
+            'providers': sorted(rnd.sample(['provider{}'.format(p) for p in range(providers + 1)],
+                                           rnd.randint(1, providers + 1))),
+            'pictures': list(contexts)
+        }
+    }
+
+
+def make_picture(rnd, size):
+    return base64.b64encode(b'\x89PNG\r\n\x1a\n' + bytes(rnd.getrandbits(8) for _ in range(size))).decode('ascii')
+
+
+def _insert(collection, docs, batch_size=5000):
+    for start in range(0, len(docs), batch_size):
+        collection.insert_many(docs[start:start + batch_size], ordered=False)
+
+
+def populate(database, service, rnd, entities=10000, events=20000, labels=20000, pictures=200, users=200,
+             providers=40, picture_size=20 * 1024):
+    contexts = ('default', 'thumbnail')
+    languages = ('fr', 'en', 'es', 'de')
+
+    subscriptions = [make_subscription(rnd, 'user{}'.format(u), providers, contexts) for u in range(users)]
+    _insert(database.subscriptions, subscriptions)
+    allowed_users = {}
+    for sub in subscriptions:
+        for provider in sub['subscription']['providers']:
+            allowed_users.setdefault(provider, []).append(sub['user'])
+
+    def with_acl(doc):
+        doc['allowed_users'] = allowed_users.get(doc['provider'], [])
+        return doc
+
+    _insert(database.entities, [with_acl(make_entity(rnd, i, providers)) for i in range(entities)])
+    _insert(database.events, [with_acl(make_event(rnd, i, providers, entities)) for i in range(events)])
+    _insert(database.labels, [make_label(rnd, i % entities, languages[(i // entities) % len(languages)], 'name')
+                              for i in range(min(labels, entities * len(languages)))])
+
+    for i in range(pictures):
+        service.add_picture_to_entity('en{}'.format(rnd.randrange(entities)), rnd.choice(contexts), 'png',
+                                      make_picture(rnd, picture_size))
+
+    return {
+        'entities': entities,
+        'events': events,
+        'labels': database.labels.count_documents({}),
+        'pictures': database.pictures.count_documents({}),
+        'users': users,
+        'providers': providers + 1
+    }